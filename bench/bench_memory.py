@@ -0,0 +1,117 @@
+"""
+Measure the memory taken by a series in the data model, compared with the
+former plain object one (a Python list of Page objects per chapter).
+
+Usage: python3 bench/bench_memory.py [--volumes N] [--chapters N] [--pages N] [--descriptor FILE]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from masc import data
+from masc.descriptor import Descriptor
+
+
+class LegacyVolume(object):
+    def __init__(self, number):
+        self.number = number
+        self.chapters = list()
+
+    def add_chapter(self, chapter):
+        self.chapters.append(chapter)
+
+
+class LegacyChapter(object):
+    def __init__(self, url, title, number, volume=None):
+        self.url = url
+        self.title = title
+        self.number = number
+        self.volume = volume
+        self.pages = list()
+
+    def add_page(self, page):
+        self.pages.append(page)
+
+
+class LegacyPage(object):
+    def __init__(self, url, number, image_url=None):
+        self.url = url
+        self.image_url = image_url
+        self.number = number
+
+
+def build_series(volume_cls, chapter_cls, page_cls, volumes, chapters, pages):
+    series = list()
+    for v in range(volumes):
+        volume = volume_cls('{:02d}'.format(v))
+        for c in range(chapters):
+            number = v * chapters + c
+            chapter_url = 'http://mangafox.me/manga/sample_series/v{:02d}/c{:03d}/1.html'.format(v, number)
+            chapter = chapter_cls(chapter_url, 'Chapter {}'.format(number), str(number), volume.number)
+            for p in range(1, pages + 1):
+                # build the strings at runtime, as they would come from a parser
+                page_url = 'http://mangafox.me/manga/sample_series/v{:02d}/c{:03d}/{}.html'.format(v, number, p)
+                image_url = 'http://z.mfcdn.net/store/manga/246/{:02d}-{:03d}.0/compressed/k{:03d}.jpg'.format(v, number, p)
+                chapter.add_page(page_cls(page_url, p, image_url))
+            volume.add_chapter(chapter)
+        series.append(volume)
+    return series
+
+
+def measure(func):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def report(name, current, peak, elapsed):
+    print("{:<10} {:>10.1f} {:>10.1f} {:>10.2f}".format(name, current / 1e6, peak / 1e6, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--volumes', default=40, type=int, help='Number of volumes (default: 40)')
+    parser.add_argument('--chapters', default=25, type=int, help='Chapters per volume (default: 25)')
+    parser.add_argument('--pages', default=100, type=int, help='Pages per chapter (default: 100)')
+    parser.add_argument('--descriptor', default=None,
+                        help='Also time loading this descriptor file, in full and one volume only')
+    args = parser.parse_args()
+
+    sizes = (args.volumes, args.chapters, args.pages)
+    print("{} pages".format(args.volumes * args.chapters * args.pages))
+    print("{:<10} {:>10} {:>10} {:>10}".format('model', 'live (MB)', 'peak (MB)', 'time (s)'))
+
+    legacy, current, peak, elapsed = measure(lambda: build_series(LegacyVolume, LegacyChapter, LegacyPage, *sizes))
+    report('legacy', current, peak, elapsed)
+    del legacy
+
+    compact, current, peak, elapsed = measure(lambda: build_series(data.Volume, data.Chapter, data.Page, *sizes))
+    report('compact', current, peak, elapsed)
+    del compact
+
+    if args.descriptor is not None:
+        descriptor, current, peak, elapsed = measure(lambda: Descriptor.load(args.descriptor))
+        report('load', current, peak, elapsed)
+        del descriptor
+
+        def open_first():
+            descriptor = Descriptor.open(args.descriptor)
+            numbers = sorted(descriptor.volumes.keys())
+            return descriptor.volumes[numbers[0]] if numbers else None
+
+        volume, current, peak, elapsed = measure(open_first)
+        report('open', current, peak, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Compare the lxml extraction path of the adapters with the former
+BeautifulSoup one on the pages saved in bench/fixtures.
+
+Usage: python3 bench/bench_parse.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import masc.adapter
+from masc.adapter import MangafoxAdapter, DynastyScansAdapter
+from masc.data import Chapter, Page
+from masc.extract import parse_html
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), mode='rb') as fp:
+        return fp.read()
+
+
+# BeautifulSoup versions of the extractions, as the adapters did them before
+# (get_meta and get_chapters each parsed the series page)
+
+def bs_mangafox_series(content):
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    title = str(html.find('h1').string)
+    cover = str(html.find('div', 'cover').img['src'])
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    links = [(link['href'], link.parent.find('span', 'title')) for link in html.find_all('a', "tips")]
+    return title, cover, len(links)
+
+
+def bs_mangafox_page(content):
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    options = [int(option['value']) for option in html.find('select', 'm').find_all('option') if option['value'] != '0']
+    image = html.find('img', id='image')['src']
+    return len(options), image
+
+
+def bs_dynasty_series(content):
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    title = html.find('h2', 'tag-title').b.string
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    chapters = [tag.a['href'] for tag in html.find('dl', 'chapter-list') if tag.name == 'dd']
+    return str(title), len(chapters)
+
+
+def bs_dynasty_chapter(content):
+    html = BeautifulSoup(content.decode('utf-8'), "lxml")
+    script = str(html.find(lambda el: el.name == 'script' and not el.has_attr('src') and 'pages' in str(el)))
+    return len(json.loads(script[script.find('var pages = [') + 12:script.rfind(';')]))
+
+
+# lxml versions, going through the real adapter methods
+
+def serve(content):
+    masc.adapter.fetch_html = lambda url, cached=False: parse_html(content)
+
+
+mangafox = MangafoxAdapter('http://mangafox.me/manga/sample_series/')
+dynasty = DynastyScansAdapter('http://dynasty-scans.com/series/sample_series')
+chapter = Chapter(url='http://mangafox.me/manga/sample_series/v01/c001/1.html', title='', number='1', volume='01')
+page = Page(url=chapter.url, number=1)
+
+
+def lxml_mangafox_series(content):
+    serve(content)
+    meta = mangafox.get_meta()
+    return meta.title, meta.cover_url, len(mangafox.get_chapters())
+
+
+def lxml_mangafox_page(content):
+    serve(content)
+    return len(mangafox.get_pages(chapter)), mangafox.get_image(page)
+
+
+def lxml_dynasty_series(content):
+    serve(content)
+    return dynasty.get_meta().title, len(dynasty.get_chapters())
+
+
+def lxml_dynasty_chapter(content):
+    serve(content)
+    return len(dynasty.get_pages(Chapter(url='/chapters/sample_series_ch01', title='', number=1)))
+
+
+CASES = [
+    ('mangafox_series.html', bs_mangafox_series, lxml_mangafox_series),
+    ('mangafox_page.html', bs_mangafox_page, lxml_mangafox_page),
+    ('dynasty_series.html', bs_dynasty_series, lxml_dynasty_series),
+    ('dynasty_chapter.html', bs_dynasty_chapter, lxml_dynasty_chapter),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=50, type=int, help='Iterations per fixture (default: 50)')
+    args = parser.parse_args()
+
+    if BeautifulSoup is None:
+        print("beautifulsoup4 is not installed, only timing lxml")
+
+    print("{:<24} {:>8} {:>12} {:>12} {:>8}".format('fixture', 'size', 'bs4 (ms)', 'lxml (ms)', 'speedup'))
+    for name, bs_func, lxml_func in CASES:
+        content = load_fixture(name)
+        result = lxml_func(content)
+        if BeautifulSoup is not None and bs_func(content) != result:
+            print("{}: results differ {!r} != {!r}".format(name, bs_func(content), result))
+        lxml_time = timeit.timeit(lambda: lxml_func(content), number=args.repeat) / args.repeat * 1000
+        if BeautifulSoup is None:
+            print("{:<24} {:>8} {:>12} {:>12.2f} {:>8}".format(name, len(content), '-', lxml_time, '-'))
+            continue
+
+        bs_time = timeit.timeit(lambda: bs_func(content), number=args.repeat) / args.repeat * 1000
+        print("{:<24} {:>8} {:>12.2f} {:>12.2f} {:>7.1f}x".format(name, len(content), bs_time, lxml_time,
+                                                                  bs_time / lxml_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Time the crawl, build and download commands end to end against the local
+stand-in site of bench/server.py, through the real adapters. Each command
+starts from an empty output directory and cache, except recrawl which runs
+the crawl again with the pages cached by the first one. pipeline is the
+download command in its pipelined mode. The stages
+recorded by masc.metrics are reported with each command.
+
+Usage: python3 bench/bench_scraper.py [--site mangafox|dynasty|all] [--volumes N] [--chapters N] [--pages N]
+                                      [--latency SECS] [--error-rate RATE] [--image-size BYTES]
+                                      [--crawl-parallel N] [--page-parallel N] [--parallel N]
+                                      [--verbose] [--json FILE]
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from masc import main as commands
+from masc.archive import CompressionPolicy
+from masc.metrics import metrics
+from server import Site, SiteServer
+
+
+SITES = {
+    'mangafox': ('MangafoxAdapter', '{}/manga/sample_series/'),
+    'dynasty': ('DynastyScansAdapter', '{}/series/sample_series'),
+}
+
+# stages reported after each command, in pipeline order
+STAGES = ('crawl.pages', 'crawl.images', 'crawl.image', 'pipeline.fetch', 'fetch', 'parse', 'http.request',
+          'transform', 'zip.write', 'build.volume')
+
+
+def serve(site_settings, ready):
+    server = SiteServer(Site(**site_settings))
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(site_settings):
+    """
+    Run the site in a process of its own, so that it doesn't compete with
+    the scraper for the interpreter
+
+    :return: (process, base url)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(site_settings, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=10)
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def command_args(**kwargs):
+    """
+    Arguments of a command, as parsed from the command line with the defaults
+    """
+    args = Namespace(pool_size=None, timeout=None, retries=None, rate_limit=None, burst=None, host_limit=None,
+                     metrics=None, progress=False, cache_dir=None, cache_size=None, cache_policy='lru',
+                     meta_ttl=None, chapters_ttl=None, pages_ttl=None, no_page_cache=False,
+                     adapter='auto', crawl_parallel=None, descriptor_format='xml', incremental=False,
+                     crawl_host_limit=None, url=None, out=None, descriptor=None, format='cbz', parallel=None,
+                     page_parallel=None, volumes=[], compression=CompressionPolicy(), resize_height=None,
+                     quality=None, image_format=None, keep_metadata=False, rebuild=False, pipeline=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def run_command(command, args, verbose):
+    """
+    :return: (seconds, metrics report)
+    """
+    metrics.reset()
+    start = time.perf_counter()
+    if verbose:
+        command(args)
+    else:
+        with open(os.devnull, mode='w') as devnull, contextlib.redirect_stdout(devnull):
+            command(args)
+    return time.perf_counter() - start, metrics.report()
+
+
+def bench_site(name, base_url, options, work_dir):
+    adapter, url_pattern = SITES[name]
+    url = url_pattern.format(base_url)
+    shared = dict(adapter=adapter, crawl_parallel=options.crawl_parallel, page_parallel=options.page_parallel,
+                  parallel=options.parallel)
+    descriptor = os.path.join(work_dir, name)
+
+    crawl_args = command_args(url=url, out=descriptor, cache_dir=os.path.join(work_dir, name + '-crawl-cache'), **shared)
+    runs = [
+        ('crawl', commands.crawl, crawl_args),
+        # the same crawl again, with the pages kept by the first one
+        ('recrawl', commands.crawl, crawl_args),
+        ('build', commands.build, command_args(descriptor=descriptor + '.xml', out=os.path.join(work_dir, name + '-build'),
+                                               cache_dir=os.path.join(work_dir, name + '-build-cache'), **shared)),
+        ('download', commands.download, command_args(url=url, out=os.path.join(work_dir, name + '-download'),
+                                                     cache_dir=os.path.join(work_dir, name + '-download-cache'),
+                                                     **shared)),
+        ('pipeline', commands.download, command_args(url=url, out=os.path.join(work_dir, name + '-pipeline'),
+                                                     cache_dir=os.path.join(work_dir, name + '-pipeline-cache'),
+                                                     pipeline=True, **shared)),
+    ]
+
+    results = dict()
+    for command, function, args in runs:
+        seconds, report = run_command(function, args, options.verbose)
+        results[command] = dict(report, seconds=seconds)
+        print_report(name, command, seconds, report)
+    return results
+
+
+def print_report(site, command, seconds, report):
+    counters = report['counters']
+    print("{} {}: {:.2f}s, {} requests, {} retries, {:.1f} MB, {} pages written, "
+          "HTML cache {} hits / {} not modified / {} misses".format(
+              site, command, seconds, counters.get('http.requests', 0), counters.get('http.retries', 0),
+              counters.get('fetch.bytes', 0) / 1e6, counters.get('zip.entries', 0), counters.get('html.hit', 0),
+              counters.get('html.not_modified', 0), counters.get('html.miss', 0)))
+    for stage in STAGES:
+        timer = report['timers'].get(stage)
+        if timer is None:
+            continue
+        print("    {:<14} {:>7} {:>10.3f}s {:>9.2f}ms {:>9.2f}ms".format(stage, timer['count'], timer['total'],
+                                                                      timer['mean'] * 1000, timer['max'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--site', default='all', choices=['mangafox', 'dynasty', 'all'], help='Site to bench (default: all)')
+    parser.add_argument('--volumes', default=2, type=int, help='Volumes per series (default: 2)')
+    parser.add_argument('--chapters', default=5, type=int, help='Chapters per volume (default: 5)')
+    parser.add_argument('--pages', default=20, type=int, help='Pages per chapter (default: 20)')
+    parser.add_argument('--latency', default=0.02, type=float, help='Delay of every response in seconds (default: 0.02)')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Share of requests failing with a 503 (default: 0)')
+    parser.add_argument('--image-size', default=100000, type=int, help='Size of the images in bytes (default: 100000)')
+    parser.add_argument('--crawl-parallel', default=None, type=int, help='Concurrent crawl threads (default: none)')
+    parser.add_argument('--page-parallel', default=None, type=int, help='Concurrent page downloads per volume (default: none)')
+    parser.add_argument('--parallel', default=None, type=int, help='Build processes (default: none)')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Show the output of the commands')
+    parser.add_argument('--json', default=None, help='Write the timings and metrics to this JSON file')
+    args = parser.parse_args()
+
+    site_settings = dict(volumes=args.volumes, chapters=args.chapters, pages=args.pages, latency=args.latency,
+                         error_rate=args.error_rate, image_size=args.image_size)
+    print("{} pages per series, {:.0f}ms latency, {:.0%} errors".format(
+        args.volumes * args.chapters * args.pages, args.latency * 1000, args.error_rate))
+    print("    {:<14} {:>7} {:>11} {:>11} {:>11}".format('stage', 'count', 'total', 'mean', 'max'))
+
+    process, base_url = start_server(site_settings)
+    work_dir = tempfile.mkdtemp(prefix='bench_scraper')
+    results = dict(settings=site_settings, sites=dict())
+    try:
+        for name in sorted(SITES.keys()):
+            if args.site in (name, 'all'):
+                results['sites'][name] = bench_site(name, base_url, args, work_dir)
+    finally:
+        process.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json is not None:
+        with open(args.json, mode='w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
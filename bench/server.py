@@ -0,0 +1,282 @@
+"""
+Local stand-in for the sites of the adapters, serving synthetic series
+shaped like the pages saved in bench/fixtures, so that the scraper can be
+timed end to end without hitting the live sites.
+
+    /manga/<slug>/                                  Mangafox series page
+    /manga/<slug>/v<VV>/c<CCC>/<P>.html             Mangafox page
+    /store/manga/<slug>/<VV>-<CCC>.0/compressed/k<PPP>.jpg
+    /series/<slug>                                  Dynasty Scans series page
+    /chapters/<slug>_ch<CCC>                        Dynasty Scans chapter
+    /system/releases/<slug>/<CCC>/<PPP>.jpg
+
+Any slug is accepted. Pages carry an ETag and are answered with a 304 to a
+matching If-None-Match. Every response is delayed by the latency and a
+share of them fail with a 503 and a Retry-After header.
+
+Usage: python3 bench/server.py [--port N] [--volumes N] [--chapters N] [--pages N]
+                               [--latency SECS] [--error-rate RATE] [--image-size BYTES]
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+FILLER = str.join(' ', ['<li><a href="/directory/{0}/" title="genre {0}">Genre {0}</a></li>'.format(n) for n in range(30)])
+
+MANGAFOX_SERIES = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title} Manga - Read {title} Online</title></head>
+<body><ul id="menu">{filler}</ul>
+<div id="title"><h1>{title} Manga</h1><h3>Author</h3></div>
+<div id="series_info"><div class="cover"><img width="200" src="{base}/store/manga/{slug}/cover.jpg" alt=""></div></div>
+<div id="chapters"><ul class="chlist">{chapters}</ul></div>
+</body></html>
+"""
+
+MANGAFOX_CHAPTER = """<li><div><h3><a href="{base}/manga/{slug}/v{volume}/c{chapter}/1.html" title="{title} {number}" class="tips">{title} {number}</a> <span class="title nowrap">Chapter title {number}</span></h3><span class="date">Jan 5, 2016</span></div></li>"""
+
+MANGAFOX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title} {number} - Page {page}</title></head>
+<body><ul id="menu">{filler}</ul>
+<div id="top_bar"><select onchange="change_page(this)" class="m">{options}<option value="0">Comments</option></select></div>
+<div id="viewer"><a href="#"><img src="{base}/store/manga/{slug}/{volume}-{chapter}.0/compressed/k{page:03d}.jpg" width="728" id="image" alt="{title} {number} Page {page}"></a></div>
+<div id="bottom_bar"><select onchange="change_page(this)" class="m">{options}<option value="0">Comments</option></select></div>
+</body></html>
+"""
+
+DYNASTY_SERIES = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Dynasty Reader &raquo; {title}</title></head>
+<body><ul id="menu">{filler}</ul>
+<h2 class="tag-title"><b>{title}</b> <small>by <a href="/authors/a">Author</a></small></h2>
+<img class="thumbnail" src="/system/tag_contents_covers/{slug}/medium/cover.jpg">
+<dl class="chapter-list">{chapters}</dl>
+</body></html>
+"""
+
+DYNASTY_CHAPTER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Dynasty Reader &raquo; {title} ch{chapter}</title>
+<script src="/assets/application.js"></script></head>
+<body><ul id="menu">{filler}</ul>
+<div id="image"><img src="{first}"></div>
+<script>
+//<![CDATA[
+        var pages = {pages};
+//]]>
+</script>
+</body></html>
+"""
+
+# pages don't change while the server runs
+LAST_MODIFIED = 'Sat, 02 Jan 2016 00:00:00 GMT'
+
+PATHS = [
+    ('mangafox_series', re.compile(r"^/manga/(?P<slug>[a-z0-9_]+)/$")),
+    ('mangafox_page', re.compile(r"^/manga/(?P<slug>[a-z0-9_]+)/v(?P<volume>\d+)/c(?P<chapter>\d+)/(?P<page>\d+)\.html$")),
+    ('dynasty_series', re.compile(r"^/series/(?P<slug>[a-zA-Z0-9_]+)$")),
+    ('dynasty_chapter', re.compile(r"^/chapters/(?P<slug>[a-zA-Z0-9_]+)_ch(?P<chapter>\d+)$")),
+    ('image', re.compile(r"^/(store|system)/.*\.jpg$")),
+]
+
+
+class Site(object):
+    """
+    Shape of the synthetic series and behaviour of the server
+    """
+
+    def __init__(self, volumes=2, chapters=5, pages=20, latency=0.0, error_rate=0.0, image_size=100000, seed=0):
+        """
+        :param volumes: Number of volumes of a series
+        :param chapters: Chapters per volume
+        :param pages: Pages per chapter
+        :param latency: Delay of every response, in seconds
+        :param error_rate: Share of the requests answered with a 503
+        :param image_size: Size of the images, in bytes
+        """
+        self.volumes = volumes
+        self.chapters = chapters
+        self.pages = pages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.image_size = image_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'bytes': 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def chapter_numbers(self):
+        """
+        :return: [(volume, chapter)] numbered from 1, in reading order
+        """
+        return [(volume, (volume - 1) * self.chapters + index)
+                for volume in range(1, self.volumes + 1)
+                for index in range(1, self.chapters + 1)]
+
+    def title(self, slug):
+        return slug.replace('_', ' ').title()
+
+    def mangafox_series(self, base, slug):
+        # the site lists the latest chapter first
+        chapters = [MANGAFOX_CHAPTER.format(base=base, slug=slug, title=self.title(slug), number=chapter,
+                                            volume='{:02d}'.format(volume), chapter='{:03d}'.format(chapter))
+                    for volume, chapter in reversed(self.chapter_numbers())]
+        return MANGAFOX_SERIES.format(base=base, slug=slug, title=self.title(slug), filler=FILLER,
+                                      chapters=str.join(' ', chapters))
+
+    def mangafox_page(self, base, slug, volume, chapter, page):
+        options = str.join('', ['<option value="{0}">{0}</option>'.format(n) for n in range(1, self.pages + 1)])
+        return MANGAFOX_PAGE.format(base=base, slug=slug, title=self.title(slug), number=int(chapter), filler=FILLER,
+                                    volume=volume, chapter=chapter, page=int(page), options=options)
+
+    def dynasty_series(self, base, slug):
+        tags = list()
+        for volume, chapter in self.chapter_numbers():
+            if chapter % self.chapters == 1 or self.chapters == 1:
+                tags.append('<dt>Volume {}</dt>'.format(volume))
+            tags.append('<dd><a href="/chapters/{0}_ch{1:03d}" class="name">Chapter {1}</a> '
+                        '<small>released Jan 2, 2016</small></dd>'.format(slug, chapter))
+        return DYNASTY_SERIES.format(slug=slug, title=self.title(slug), filler=FILLER, chapters=str.join(' ', tags))
+
+    def dynasty_chapter(self, base, slug, chapter):
+        pages = [{'image': '/system/releases/{}/{}/{:03d}.jpg'.format(slug, chapter, page), 'name': '{:03d}'.format(page)}
+                 for page in range(1, self.pages + 1)]
+        return DYNASTY_CHAPTER.format(title=self.title(slug), chapter=chapter, filler=FILLER,
+                                      first=pages[0]['image'], pages=json.dumps(pages))
+
+    def image(self, path):
+        """
+        Content of an image, the same for a path on every run
+        """
+        seed = hashlib.sha1(path.encode('utf-8')).digest()
+        body = seed * (self.image_size // len(seed) + 1)
+        return b'\xff\xd8\xff\xe0' + body[:max(self.image_size - 6, 0)] + b'\xff\xd9'
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let them wait for an ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def respond(self, head):
+        site = self.server.site
+        site.count('requests')
+        if site.latency > 0:
+            time.sleep(site.latency)
+
+        if site.fail():
+            site.count('errors')
+            self.send(503, b'Service Unavailable', 'text/plain', head, {'Retry-After': '0'})
+            return
+
+        path = self.path.partition('?')[0]
+        base = 'http://{}'.format(self.headers.get('Host'))
+        for name, pattern in PATHS:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if name == 'image':
+                self.send(200, site.image(path), 'image/jpeg', head)
+            else:
+                body = getattr(site, name)(base, **match.groupdict()).encode('utf-8')
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                headers = {'ETag': etag, 'Last-Modified': LAST_MODIFIED}
+                if self.headers.get('If-None-Match') == etag:
+                    self.send(304, b'', 'text/html; charset=utf-8', head, headers)
+                else:
+                    self.send(200, body, 'text/html; charset=utf-8', head, headers)
+            return
+
+        self.send(404, b'Not Found', 'text/plain', head)
+
+    def send(self, status, body, content_type, head, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+            self.server.site.count('bytes', len(body))
+
+
+class SiteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site, address=('127.0.0.1', 0)):
+        super().__init__(address, SiteHandler)
+        self.site = site
+
+    def handle_error(self, request, client_address):
+        # clients closing their kept-alive connections
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """
+        Serve from a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, name='site-server', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=8000, type=int, help='Port to listen on (default: 8000)')
+    parser.add_argument('--volumes', default=2, type=int, help='Volumes per series (default: 2)')
+    parser.add_argument('--chapters', default=5, type=int, help='Chapters per volume (default: 5)')
+    parser.add_argument('--pages', default=20, type=int, help='Pages per chapter (default: 20)')
+    parser.add_argument('--latency', default=0.0, type=float, help='Delay of every response in seconds (default: 0)')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Share of requests failing with a 503 (default: 0)')
+    parser.add_argument('--image-size', default=100000, type=int, help='Size of the images in bytes (default: 100000)')
+    args = parser.parse_args()
+
+    site = Site(volumes=args.volumes, chapters=args.chapters, pages=args.pages, latency=args.latency,
+                error_rate=args.error_rate, image_size=args.image_size)
+    server = SiteServer(site, ('127.0.0.1', args.port))
+    print("Mangafox:     {}/manga/sample_series/".format(server.base_url))
+    print("Dynasty Scans: {}/series/sample_series".format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
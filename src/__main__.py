@@ -3,49 +3,114 @@ import sys
 
 if __name__ == "__main__":
     try:
-        import bs4
+        import lxml
         import requests
     except ImportError:
-        print("Requires packages requests and beautifulsoup4")
+        print("Requires packages requests and lxml")
         exit(-1)
 
-    if sys.hexversion < 0x03030000:
-        print("Your python version is not supported (python 3.3+ required)")
+    if sys.hexversion < 0x03060000:
+        print("Your python version is not supported (python 3.6+ required)")
         exit(-1)
 
+    from masc.archive import CompressionPolicy
+
+    def compression(spec):
+        try:
+            return CompressionPolicy.parse(spec)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
     main_parser = argparse.ArgumentParser()
     subparsers = main_parser.add_subparsers(dest='mode')
 
+    http_parser = argparse.ArgumentParser(add_help=False)
+    http_parser.add_argument('--pool-size', default=None, type=int, help='Connections kept alive per host (default: 10)')
+    http_parser.add_argument('--timeout', default=None, type=float, help='HTTP timeout in seconds (default: 30)')
+    http_parser.add_argument('--retries', default=None, type=int, help='Retries on connection errors, 429 and 5xx (default: 3)')
+    http_parser.add_argument('--rate-limit', default=None, type=float, help='Requests per second per host (default: unbounded)')
+    http_parser.add_argument('--burst', default=None, type=int, help='Requests sent at once before the rate limit applies (default: 1)')
+    http_parser.add_argument('--host-limit', default=None, type=int, help='Maximum concurrent requests per host, adapted to errors (default: unbounded)')
+
+    metrics_parser = argparse.ArgumentParser(add_help=False)
+    metrics_parser.add_argument('--metrics', default=None, help='Write timings, counters and latency histograms to this JSON file')
+    metrics_parser.add_argument('--progress', action='store_true', default=False, help='Show a live status line on stderr')
+
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument('--cache-dir', default='cache', help='Image cache directory (default: cache)')
+    cache_parser.add_argument('--cache-size', default=None, help='Cache budget for images and HTML pages, e.g. 20G (default: unbounded)')
+    cache_parser.add_argument('--cache-policy', default='lru', choices=['lru', 'lfu'], help='Image cache eviction policy (default: lru)')
+
+    page_cache_parser = argparse.ArgumentParser(add_help=False)
+    page_cache_parser.add_argument('--meta-ttl', default=None, type=float, help='Seconds a cached series page is used for the metadata without asking the site (default: 86400)')
+    page_cache_parser.add_argument('--chapters-ttl', default=None, type=float, help='Seconds a cached series page is used for the chapter list without asking the site (default: 0)')
+    page_cache_parser.add_argument('--pages-ttl', default=None, type=float, help='Seconds a cached chapter page is used for the page list without asking the site (default: 2592000)')
+    page_cache_parser.add_argument('--no-page-cache', action='store_true', default=False, help='Always fetch HTML pages in full')
+
     crawl_parser = argparse.ArgumentParser(add_help=False)
     crawl_parser.add_argument('--adapter', default='auto', help='Adapter class (default: auto)')
-    crawl_parser_impl = subparsers.add_parser('crawl', parents=[crawl_parser], help='Builds an XML descriptor from an URL')
+    crawl_parser.add_argument('--crawl-parallel', default=None, type=int, help='Number of concurrent crawl threads (default: none)')
+    crawl_parser.add_argument('--descriptor-format', default='xml', choices=['xml', 'db'], help='Descriptor file format (default: xml)')
+    crawl_parser.add_argument('--incremental', action='store_true', default=False, help='Only crawl chapters missing from the existing descriptor')
+    crawl_parser.add_argument('--crawl-host-limit', default=None, type=int, help='Maximum concurrent requests per host while crawling (default: unbounded)')
+    crawl_parser_impl = subparsers.add_parser('crawl', parents=[crawl_parser, http_parser, cache_parser, page_cache_parser, metrics_parser], help='Builds an XML descriptor from an URL')
     crawl_parser_impl.add_argument('url', help='URL of the manga')
     crawl_parser_impl.add_argument('--out', default=None, help='Output file')
 
     build_parser = argparse.ArgumentParser(add_help=False)
     build_parser.add_argument('--format', default='cbz', help='Output format (ebook, cbz)')
     build_parser.add_argument('--out', default=None, help='Output directory (default: current)')
-    build_parser.add_argument('--parallel', default=None, type=int, help='Number of concurrent threads (default: none)')
+    build_parser.add_argument('--page-parallel', default=None, type=int, help='Number of concurrent page downloads per volume (default: none)')
     build_parser.add_argument('--volumes', default=[], nargs='*', help="Specify chapters to build")
-    build_parser_impl = subparsers.add_parser('build', parents=[build_parser], help='Downloads files from an XML descriptor')
+    build_parser.add_argument('--compression', default=CompressionPolicy(), type=compression,
+                              help='Archive compression: store, auto, deflate[:level] or zstd[:level], auto stores JPEG, '
+                                   'GIF and WebP images and deflates the rest, compressing on --page-parallel '
+                                   'threads or one per core (default: store)')
+    build_parser.add_argument('--resize-height', default=None, type=int, help='Scale down taller images to this height (requires Pillow)')
+    build_parser.add_argument('--quality', default=None, type=int, help='JPEG/WebP quality of transformed images (requires Pillow)')
+    build_parser.add_argument('--image-format', default=None, choices=['jpeg', 'webp'], help='Re-encode images to this format (requires Pillow)')
+    build_parser.add_argument('--keep-metadata', action='store_true', default=False, help='Keep EXIF and ICC data of transformed images')
+    # not for sync, whose series share the workers of a single process
+    parallel_parser = argparse.ArgumentParser(add_help=False)
+    parallel_parser.add_argument('--parallel', default=None, type=int, help='Number of concurrent threads (default: none)')
+
+    build_parser_impl = subparsers.add_parser('build', parents=[build_parser, parallel_parser, http_parser, cache_parser, metrics_parser], help='Downloads files from an XML descriptor')
     build_parser_impl.add_argument('descriptor', help='Name of the descriptor file')
 
-    dl_parser = subparsers.add_parser('download', parents=[crawl_parser, build_parser], aliases=['dl'], help='Combines "crawl"+"build"')
+    dl_parser = subparsers.add_parser('download', parents=[crawl_parser, build_parser, parallel_parser, http_parser, cache_parser, page_cache_parser, metrics_parser], aliases=['dl'], help='Combines "crawl"+"build"')
     dl_parser.add_argument('url', help='URL of the manga')
     dl_parser.add_argument('--rebuild', action='store_true', default=False, help="Rebuild chapter cache")
+    dl_parser.add_argument('--pipeline', action='store_true', default=False,
+                           help='Build each volume as soon as it is crawled instead of crawling the whole series first (--parallel sets the builder threads)')
 
     fix_parser = subparsers.add_parser('fix', help='Fix CBZ files in a path')
     fix_parser.add_argument('path', metavar='path', default='.', help='path to search CBZ files')
+    fix_parser.add_argument('--parallel', default=None, type=int, help='Number of processes (default: one per core)')
+
+    sync_parser = subparsers.add_parser('sync', parents=[build_parser, http_parser, cache_parser, page_cache_parser, metrics_parser],
+                                        help='Downloads all the series of a library manifest')
+    sync_parser.add_argument('manifest', help='Library manifest (JSON)')
+    sync_parser.add_argument('--workers', default=2, type=int, help='Number of series synced at once, spread across sites (default: 2)')
+    sync_parser.add_argument('--summary', default=None, help='Write the per-series results to this JSON file')
+
+    cache_cmd_parser = subparsers.add_parser('cache', parents=[cache_parser], help='Manages the image cache')
+    cache_cmd_parser.add_argument('action', choices=['stats', 'prune', 'verify', 'migrate'], help='Cache operation')
+    cache_cmd_parser.add_argument('--repair', action='store_true', default=False, help='Fix problems found by verify')
+    cache_cmd_parser.add_argument('--deep', action='store_true', default=False, help='Re-hash files during verify')
 
     show_parser = subparsers.add_parser('show', help='Shows the contents of a descriptor')
     show_parser.add_argument('descriptor', help='Name of the descriptor file')
 
+    convert_parser = subparsers.add_parser('convert', help='Converts a descriptor between formats (.xml, .db)')
+    convert_parser.add_argument('source', help='Name of the source descriptor file')
+    convert_parser.add_argument('target', help='Name of the target descriptor file')
+
     edit_parser = subparsers.add_parser('edit', help='Edits a descriptor')
     edit_parser.add_argument('descriptor', help='Name of the descriptor file')
 
     args = main_parser.parse_args()
 
-    from masc.main import download, fix_path, crawl, build, show, edit
+    from masc.main import download, fix_path, crawl, build, sync, cache, convert, show, edit
 
     if args.mode in ('download', 'dl'):
         download(args)
@@ -53,8 +118,14 @@ if __name__ == "__main__":
         crawl(args)
     elif args.mode == 'build':
         build(args)
+    elif args.mode == 'sync':
+        sync(args)
     elif args.mode == 'fix':
         fix_path(args)
+    elif args.mode == 'cache':
+        cache(args)
+    elif args.mode == 'convert':
+        convert(args)
     elif args.mode == 'show':
         show(args)
     elif args.mode == 'edit':
@@ -1,7 +1,9 @@
 import re
 import json
+from urllib.parse import urljoin
 from masc.scraper import *
 from masc.util import fetch_html
+from masc.extract import Selector, has_class
 
 
 def auto(url):
@@ -17,8 +19,32 @@ def mangafox(url):
     return MangafoxAdapter(url)
 
 
+def derive_pattern(image_url, number):
+    """
+    Find the page number in the file name of an image url
+
+    :return: function building the url of another page, None if the number is not found
+    """
+    url, sep, query = image_url.partition('?')
+    head, _, name = url.rpartition('/')
+    for match in reversed(list(re.finditer(r"\d+", name))):
+        if int(match.group()) == int(number):
+            width = len(match.group())
+            prefix = head + '/' + name[:match.start()]
+            suffix = name[match.end():] + sep + query
+            return lambda n: prefix + str(n).zfill(width) + suffix
+    return None
+
+
 class MangafoxAdapter(SiteAdapter):
-    url_pattern = re.compile(r"http://mangafox.\w+/manga/(?P<slug>[a-z0-9_]+)((/v(?P<volume>[^/]+))?/c(?P<chapter>[^/]+)/((?P<page>[^/]+).html)?)?")
+    url_pattern = re.compile(r"(?P<base>http://[^/]+)/manga/(?P<slug>[a-z0-9_]+)((/v(?P<volume>[^/]+))?/c(?P<chapter>[^/]+)/((?P<page>[^/]+).html)?)?")
+
+    title_selector = Selector('//h1')
+    cover_selector = Selector('//div[{}]//img/@src'.format(has_class('cover')))
+    chapter_link_selector = Selector('//a[{}]'.format(has_class('tips')))
+    chapter_title_selector = Selector('..//span[{}]'.format(has_class('title')))
+    page_option_selector = Selector('(//select[{}])[1]//option'.format(has_class('m')))
+    image_selector = Selector('//img[@id="image"]/@src')
 
     def __init__(self, url):
         super().__init__(url)
@@ -26,68 +52,109 @@ class MangafoxAdapter(SiteAdapter):
         if match is None:
             raise RuntimeError("URL does not match mangafox pattern")
 
+        # pages are requested on the host of the manga url
+        self.base = match.group('base')
         self.slug = match.group('slug')
 
     def build_url(self, volume=None, chapter=None, page=None, root=False):
         if root:
-            pattern = r"http://mangafox.me/manga/{slug}/"
+            pattern = r"{base}/manga/{slug}/"
         elif volume is None:
-            pattern = r"http://mangafox.me/manga/{slug}/c{chapter}/{page}.html"
+            pattern = r"{base}/manga/{slug}/c{chapter}/{page}.html"
         else:
-            pattern = r"http://mangafox.me/manga/{slug}/v{volume}/c{chapter}/{page}.html"
+            pattern = r"{base}/manga/{slug}/v{volume}/c{chapter}/{page}.html"
 
-        return pattern.format(slug=self.slug, volume=volume, chapter=chapter, page=page)
+        return pattern.format(base=self.base, slug=self.slug, volume=volume, chapter=chapter, page=page)
 
     def make_chapter(self, link):
-        title = link.parent.find('span', 'title')
-        url = link['href']
+        title = self.chapter_title_selector.text(link)
+        url = link.get('href')
         match = self.url_pattern.match(url)
         chap, vol = match.group('chapter', 'volume')
         if chap is None:
             raise RuntimeError("{} does not contain a chapter number".format(url))
-        return Chapter(url=link['href'],
-                       title=str(title.string) if title is not None else "Chapter {}".format(chap),
+        return Chapter(url=url,
+                       title=title if title is not None else "Chapter {}".format(chap),
                        number=str(chap),
                        volume=str(vol) if vol is not None else None)
 
     def make_page(self, option, chapter):
-        page_no = int(option['value'])
+        page_no = int(option.get('value'))
         return Page(url=self.build_url(volume=chapter.volume, chapter=chapter.number, page=page_no),
                     number=page_no)
 
+    def shown_page(self, chapter):
+        """
+        Number of the page shown by the chapter url, None if it is not given
+        """
+        match = self.url_pattern.match(chapter.url)
+        if match is None or match.group('page') is None:
+            return None
+        try:
+            return int(match.group('page'))
+        except ValueError:
+            return None
+
     def get_meta(self):
-        html = fetch_html(self.manga_url)
-        meta = Metadata(slug=self.slug, title=str(html.find('h1').string))
-        meta.cover_url = str(html.find('div', 'cover').img['src'])
+        html = fetch_html(self.manga_url, cached='meta')
+        meta = Metadata(slug=self.slug, title=self.title_selector.text(html))
+        meta.cover_url = str(self.cover_selector.first(html))
         return meta
 
     def get_chapters(self):
-        html = fetch_html(self.manga_url)
+        html = fetch_html(self.manga_url, cached='chapters')
         chapters_links = map(self.make_chapter,
-                             html.find_all('a', "tips"))
+                             self.chapter_link_selector.all(html))
         return list(chapters_links)
 
     def get_pages(self, chapter):
-        html = fetch_html(chapter.url)
-        select_tag = html.find('select', 'm')
-        if select_tag is None:
+        html = fetch_html(chapter.url, cached='pages')
+        options = self.page_option_selector.all(html)
+        if len(options) == 0:
             raise RuntimeError("{} does not contain a select.m".format(chapter.url))
         page_numbers = filter(lambda page: page.number != 0,
                               map(lambda option: self.make_page(option, chapter),
-                                  select_tag.find_all('option')))
-        return list(page_numbers)
+                                  options))
+        pages = list(page_numbers)
+
+        # the chapter url is one of the pages, its image is on the page already fetched
+        shown = self.shown_page(chapter)
+        src = self.image_selector.first(html)
+        for page in pages:
+            if page.number == shown and src is not None:
+                page.image_url = str(src)
+        return pages
 
     def get_image(self, page):
         html = fetch_html(page.url)
-        img = html.find('img', id='image')
-        if img is None:
+        src = self.image_selector.first(html)
+        if src is None:
             raise RuntimeError("{} does not contain an img#image".format(page.url))
 
-        return img['src']
+        return str(src)
+
+    def get_images(self, chapter):
+        """
+        Derive the image urls of a chapter from the one `get_pages` read on
+        the chapter page, without any request. The guesses are not checked,
+        an image that fails to download is resolved from the HTML of its
+        page instead (see `ArchiveAdapter.fetch_page`).
+        """
+        known = [page for page in chapter.pages if page.image_url is not None]
+        pattern = derive_pattern(known[0].image_url, known[0].number) if len(known) > 0 else None
+        if pattern is None:
+            return [page.image_url for page in chapter.pages]
+        return [page.image_url if page.image_url is not None else pattern(page.number) for page in chapter.pages]
 
 
 class DynastyScansAdapter(SiteAdapter):
-    url_pattern = re.compile(r"http://dynasty-scans.com/series/(?P<slug>[a-zA-Z0-9_]+)")
+    url_pattern = re.compile(r"(?P<base>http://[^/]+)/series/(?P<slug>[a-zA-Z0-9_]+)")
+
+    title_selector = Selector('//h2[{}]/b'.format(has_class('tag-title')))
+    cover_selector = Selector('//img[{}]/@src'.format(has_class('thumbnail')))
+    chapter_list_selector = Selector('(//dl[{}])[1]/*'.format(has_class('chapter-list')))
+    chapter_link_selector = Selector('a[1]')
+    pages_script_selector = Selector('//script[not(@src) and contains(., "pages")]/text()')
 
     def __init__(self, url):
         super().__init__(url)
@@ -95,40 +162,42 @@ class DynastyScansAdapter(SiteAdapter):
         if match is None:
             raise RuntimeError("URL does not match dynasty-scans pattern")
 
+        self.base = match.group('base')
         self.slug = match.group('slug')
 
     def build_url(self, path):
-        pattern = r"http://dynasty-scans.com{path}"
-        return pattern.format(path=path)
+        pattern = r"{base}{path}"
+        return pattern.format(base=self.base, path=path)
 
     def get_meta(self):
-        html = fetch_html(self.manga_url)
-        meta = Metadata(slug=self.slug, title=str(html.find('h2', 'tag-title').b))
-        meta.cover_url = str(html.find('img', 'thumbnail')['src'])
+        html = fetch_html(self.manga_url, cached='meta')
+        meta = Metadata(slug=self.slug, title=self.title_selector.text(html))
+        cover = self.cover_selector.first(html)
+        # the site links the cover relative to the series page
+        meta.cover_url = None if cover is None else urljoin(self.manga_url, str(cover))
 
         return meta
 
     def get_chapters(self):
-        html = fetch_html(self.manga_url)
-        chapters_tag = html.find('dl', 'chapter-list')
+        html = fetch_html(self.manga_url, cached='chapters')
         current_volume = '00'
         index = 1
         chapters = list()
-        for tag in chapters_tag:
-            if tag.name == 'dt':
-                _, num = str(tag.string).split(' ', maxsplit=1)
+        for tag in self.chapter_list_selector.all(html):
+            if tag.tag == 'dt':
+                _, num = tag.text_content().strip().split(' ', maxsplit=1)
                 current_volume = num
-            elif tag.name == 'dd':
-                url = tag.a['href']
-                chapter = Chapter(url=url, title=str(tag.a.string), number=index, volume=current_volume)
+            elif tag.tag == 'dd':
+                link = self.chapter_link_selector.first(tag)
+                chapter = Chapter(url=link.get('href'), title=link.text_content().strip(), number=index, volume=current_volume)
                 chapters.append(chapter)
                 index += 1
 
         return chapters
 
     def get_pages(self, chapter):
-        html = fetch_html(self.build_url(path=chapter.url))
-        script = str(html.find(lambda el: el.name == 'script' and not el.has_attr('src') and 'pages' in str(el)))
+        html = fetch_html(self.build_url(path=chapter.url), cached='pages')
+        script = str(self.pages_script_selector.first(html, default=''))
 
         start_idx = script.find('var pages = [')
         end_idx = script.rfind(';')
@@ -147,3 +216,6 @@ class DynastyScansAdapter(SiteAdapter):
 
     def get_image(self, page):
         return page.image_url
+
+    def get_images(self, chapter):
+        return [page.image_url for page in chapter.pages]
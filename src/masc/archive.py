@@ -0,0 +1,324 @@
+import json
+import os
+import struct
+import zipfile
+import zlib
+from zipfile import ZipInfo
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def entry_offset(archive, info):
+    """
+    Find the offset of the compressed data of an entry
+
+    :param archive: ZipFile opened for reading
+    :param info: ZipInfo of the entry
+    :return: offset in archive.fp
+    """
+    archive.fp.seek(info.header_offset)
+    header = archive.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated file header for {}".format(info.filename))
+    fheader = struct.unpack(zipfile.structFileHeader, header)
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header of {}".format(info.filename))
+    return (info.header_offset + zipfile.sizeFileHeader +
+            fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+
+def copy_entry(source, info, target, name=None):
+    """
+    Copy an entry between two archives without decompressing it
+
+    :param source: ZipFile opened for reading
+    :param info: ZipInfo of the entry in `source`
+    :param target: ZipFile opened for writing or appending
+    :param name: New name of the entry (default: unchanged)
+    :return: ZipInfo of the new entry
+    """
+    new_info = ZipInfo(name if name is not None else info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.create_system = info.create_system
+    new_info.external_attr = info.external_attr
+    new_info.internal_attr = info.internal_attr
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    # sizes are known, no data descriptor follows the copied data
+    new_info.flag_bits = info.flag_bits & ~0x08
+
+    with source._lock:
+        offset = entry_offset(source, info)
+
+        def chunks():
+            source.fp.seek(offset)
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = source.fp.read(min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    raise zipfile.BadZipFile("Truncated data for {}".format(info.filename))
+                yield chunk
+                remaining -= len(chunk)
+
+        write_raw_entry(target, new_info, chunks())
+
+    return new_info
+
+
+def write_raw_entry(target, info, chunks):
+    """
+    Write an entry whose data is already compressed
+
+    :param target: ZipFile opened for writing or appending
+    :param info: ZipInfo with compress_type, CRC and sizes set
+    :param chunks: Iterable of the compressed data
+    """
+    with target._lock:
+        target.fp.seek(target.start_dir)
+        info.header_offset = target.fp.tell()
+        zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+        target.fp.write(info.FileHeader(zip64))
+        for chunk in chunks:
+            target.fp.write(chunk)
+
+        target.start_dir = target.fp.tell()
+        target.filelist.append(info)
+        target.NameToInfo[info.filename] = info
+        target._didModify = True
+
+
+# magic bytes of image formats that don't compress any further
+COMPRESSED_SIGNATURES = (
+    b'\xff\xd8\xff',      # JPEG
+    b'GIF87a',
+    b'GIF89a',
+    b'\x00\x00\x00\x0cjP  ',  # JPEG 2000
+)
+
+ZIP_ZSTANDARD = getattr(zipfile, 'ZIP_ZSTANDARD', None)
+
+
+def is_compressed(head):
+    """
+    Whether data starting with `head` is already compressed
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return any(head.startswith(signature) for signature in COMPRESSED_SIGNATURES)
+
+
+class CompressionPolicy(object):
+    """
+    Compression of archive entries: store, deflate or zstd (when zipfile
+    supports it) every entry, or auto to store the entries that are
+    compressed already and deflate the others
+    """
+
+    METHODS = ('store', 'auto', 'deflate', 'zstd')
+
+    def __init__(self, method='store', level=None):
+        if method not in self.METHODS:
+            raise ValueError("unknown compression {}".format(method))
+        if method == 'zstd' and ZIP_ZSTANDARD is None:
+            raise ValueError("zstd compression needs a Python with zipfile.ZIP_ZSTANDARD")
+        self.method = method
+        self.level = level
+
+    @staticmethod
+    def parse(spec):
+        """
+        Read a policy from the command line, as method[:level]
+        """
+        method, _, level = spec.partition(':')
+        return CompressionPolicy(method, int(level) if level else None)
+
+    def compress_type(self, head):
+        if self.method == 'store' or (self.method == 'auto' and is_compressed(head)):
+            return zipfile.ZIP_STORED
+        if self.method == 'zstd':
+            return ZIP_ZSTANDARD
+        return zipfile.ZIP_DEFLATED
+
+    def compressor(self, compress_type):
+        if compress_type == zipfile.ZIP_DEFLATED:
+            level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+            # raw deflate stream, as stored in zip entries
+            return zlib.compressobj(level, zlib.DEFLATED, -15)
+        if compress_type == ZIP_ZSTANDARD:
+            from compression import zstd
+            return zstd.ZstdCompressor(level=self.level)
+        return None
+
+    def __repr__(self):
+        if self.level is None:
+            return self.method
+        return "{}:{}".format(self.method, self.level)
+
+
+class EntryCompressor(object):
+    """
+    File object compressing what is written to it according to a policy,
+    the compression type is picked from the first bytes
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.compress_type = None
+        self.compressor = None
+        self.chunks = list()
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        if self.compress_type is None:
+            self.compress_type = self.policy.compress_type(bytes(data[:16]))
+            self.compressor = self.policy.compressor(self.compress_type)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.compressor is None:
+            self.chunks.append(bytes(data))
+        else:
+            self.chunks.append(self.compressor.compress(data))
+        return len(data)
+
+    def finish(self, info):
+        """
+        Fill `info` with the compression type, CRC and sizes
+
+        :return: [bytes] compressed data
+        """
+        if self.compress_type is None:
+            self.compress_type = zipfile.ZIP_STORED
+        if self.compressor is not None:
+            self.chunks.append(self.compressor.flush())
+        info.compress_type = self.compress_type
+        info.CRC = self.crc
+        info.file_size = self.size
+        info.compress_size = sum(len(chunk) for chunk in self.chunks)
+        return self.chunks
+
+
+def entry_source(info):
+    """
+    Source url recorded in the comment of an entry, None for archives
+    written before urls were recorded
+    """
+    if len(info.comment) == 0:
+        return None
+    return info.comment.decode('utf-8')
+
+
+class Journal(object):
+    """
+    Progress journal of an archive being written, one JSON line per entry
+    once its data is on disk. The entries of an interrupted archive are
+    read back by `resume_archive`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+
+    def read(self):
+        """
+        Entries recorded so far, a line cut short by a crash is ignored
+
+        :return: [dict]
+        """
+        records = list()
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def open(self, records=()):
+        """
+        Start recording, keeping `records`
+        """
+        self.fp = open(self.path, mode='w', encoding='utf-8')
+        for record in records:
+            self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+    def record(self, archive, info):
+        """
+        Record an entry written to `archive`
+        """
+        # the entry must be on disk before the journal says so
+        archive.fp.flush()
+        self.fp.write(json.dumps({
+            'name': info.filename,
+            'offset': info.header_offset,
+            'end': archive.start_dir,
+            'date_time': list(info.date_time),
+            'compress_type': info.compress_type,
+            'flag_bits': info.flag_bits,
+            'create_system': info.create_system,
+            'external_attr': info.external_attr,
+            'crc': info.CRC,
+            'compress_size': info.compress_size,
+            'file_size': info.file_size,
+            'comment': info.comment.decode('utf-8'),
+        }) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def resume_archive(path, records):
+    """
+    Reopen an interrupted archive for writing after its last recorded entry.
+    Anything written after it is dropped.
+
+    :param path: Archive written without its central directory
+    :param records: Entries read from its `Journal`
+    :return: ZipFile opened for writing, holding the recorded entries
+    """
+    end = records[-1]['end'] if len(records) > 0 else 0
+    fp = open(path, mode='r+b')
+    try:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell() < end:
+            raise zipfile.BadZipFile("{} is shorter than its journal".format(path))
+        fp.truncate(end)
+        fp.seek(end)
+        archive = zipfile.ZipFile(fp, mode='w')
+    except:
+        fp.close()
+        raise
+    # the archive closes the file like one it opened itself
+    archive._filePassed = 0
+
+    for record in records:
+        info = ZipInfo(record['name'], tuple(record['date_time']))
+        info.compress_type = record['compress_type']
+        info.flag_bits = record['flag_bits']
+        info.create_system = record['create_system']
+        info.external_attr = record['external_attr']
+        info.CRC = record['crc']
+        info.compress_size = record['compress_size']
+        info.file_size = record['file_size']
+        info.comment = record['comment'].encode('utf-8')
+        info.header_offset = record['offset']
+        archive.filelist.append(info)
+        archive.NameToInfo[info.filename] = info
+    return archive
@@ -0,0 +1,583 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS urls (
+    key TEXT PRIMARY KEY,
+    url TEXT,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    url TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    content_type TEXT,
+    digest TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+CREATE INDEX IF NOT EXISTS urls_digest ON urls (digest);
+CREATE INDEX IF NOT EXISTS pages_fetched ON pages (fetched);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('total_size', 0);
+-- counted once for the indexes made before the page bytes were tracked
+INSERT OR IGNORE INTO meta (name, value)
+    SELECT 'pages_size', COALESCE(SUM(LENGTH(body)), 0) FROM pages
+    WHERE NOT EXISTS (SELECT 1 FROM meta WHERE name = 'pages_size');
+"""
+
+# seconds a cached page is used without asking the site, per adapter method
+PAGE_TTLS = {
+    'meta': 24 * 3600,
+    'chapters': 0,
+    'pages': 30 * 24 * 3600,
+}
+
+EVICTION_ORDER = {
+    'lru': 'last_access ASC',
+    'lfu': 'hits ASC, last_access ASC'
+}
+
+# number of hex digits of the url key used to pick a lock file
+LOCK_STRIPES = 3
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    """
+    Parse a human readable size ("500M", "20G", "1024")
+
+    :return: size in bytes or None
+    """
+    if text is None:
+        return None
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", str(text), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size {}".format(text))
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return "{:.1f}{}B".format(size, unit) if unit else "{}B".format(size)
+        size /= 1024
+    return "{:.1f}TB".format(size)
+
+
+def url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class CacheWriter(object):
+    """
+    File wrapper hashing the content as it is written
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+
+class ImageCache(object):
+    """
+    Content-addressed image cache
+
+    Files are stored once per content under objects/<sha1 of content> and
+    indexed in a SQLite database mapping the url keys to their content,
+    along with the size, last access time and hit count used for eviction.
+    """
+
+    def __init__(self, root='cache', max_size=None, policy='lru'):
+        """
+        :param root: Cache directory
+        :param max_size: Byte budget (None for unbounded)
+        :param policy: Eviction policy (lru, lfu)
+        """
+        self.configure(root, max_size, policy)
+
+    def configure(self, root='cache', max_size=None, policy='lru'):
+        if policy not in EVICTION_ORDER:
+            raise ValueError("Unknown eviction policy {}".format(policy))
+        self.root = root
+        self.max_size = max_size
+        self.policy = policy
+        self.local = threading.local()
+        self.thread_locks = dict()
+        self.thread_locks_lock = threading.Lock()
+
+    def connection(self):
+        # sqlite connections can't be shared between threads or processes
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:4], digest)
+
+    def legacy_path(self, key):
+        # layout used before the index: cache/<sha1 of url in 8-char dirs>
+        return os.path.join(self.root, *[key[i:i + 8] for i in range(0, len(key), 8)])
+
+    def lookup(self, url):
+        """
+        Find the cached file for `url` and mark it as used
+
+        :return: path or None
+        """
+        key = url_key(url)
+        row = self.connection().execute('SELECT digest FROM urls WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return self.adopt(key, url)
+
+        digest = row[0]
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            self.forget(digest)
+            return None
+
+        with self.transaction() as conn:
+            conn.execute('UPDATE blobs SET last_access = ?, hits = hits + 1 WHERE digest = ?', (time.time(), digest))
+        return path
+
+    def digest(self, url):
+        """
+        Content digest of the cached file for `url`
+
+        :return: hex digest or None on a cache miss
+        """
+        path = self.lookup(url)
+        if path is None:
+            return None
+        return os.path.basename(path)
+
+    def adopt(self, key, url=None):
+        """
+        Move a file from the legacy layout into the index
+
+        :return: path or None, also when another worker moved the file first
+        """
+        legacy = self.legacy_path(key)
+        if not os.path.isfile(legacy):
+            return None
+
+        try:
+            digest, size = hash_file(legacy)
+            return self.commit(key, url, legacy, digest, size)
+        except FileNotFoundError:
+            # a miss, the caller downloads it again under the url lock if the other worker hasn't indexed it yet
+            return None
+
+    @contextmanager
+    def lock(self, url):
+        """
+        Hold an exclusive lock on `url` across threads and processes, used so
+        that a single worker downloads a missing file while the others wait
+        """
+        stripe = url_key(url)[:LOCK_STRIPES]
+        if fcntl is None:
+            with self.thread_locks_lock:
+                thread_lock = self.thread_locks.setdefault(stripe, threading.Lock())
+            with thread_lock:
+                yield
+            return
+
+        lock_dir = os.path.join(self.root, 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        # flock locks belong to the open file, so threads of a process exclude each other as well
+        with open(os.path.join(lock_dir, stripe), mode='a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def writer(self, url):
+        """
+        Open a file to store the content of `url`, it is indexed once the
+        block exits without error and discarded otherwise.
+        The content is written to a temporary file and renamed in place, so
+        readers never see a partial file.
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                cache_file = CacheWriter(fp)
+                yield cache_file
+            self.commit(url_key(url), url, tmp, cache_file.hash.hexdigest(), cache_file.size)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def commit(self, key, url, source, digest, size):
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source, path)
+
+        with self.transaction() as conn:
+            now = time.time()
+            cursor = conn.execute('INSERT OR IGNORE INTO blobs (digest, size, last_access, hits) VALUES (?, ?, ?, 0)',
+                                  (digest, size, now))
+            if cursor.rowcount == 1:
+                conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_size'", (size,))
+            else:
+                conn.execute('UPDATE blobs SET last_access = ? WHERE digest = ?', (now, digest))
+            conn.execute('INSERT OR REPLACE INTO urls (key, url, digest) VALUES (?, ?, ?)', (key, url, digest))
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return path
+
+    def forget(self, digest):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT size FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_size'", (row[0],))
+            conn.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+
+    def forget_page(self, key):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT LENGTH(body) FROM pages WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM pages WHERE key = ?', (key,))
+                conn.execute("UPDATE meta SET value = value - ? WHERE name = 'pages_size'", (row[0],))
+
+    def total_size(self, conn=None):
+        if conn is None:
+            conn = self.connection()
+        return conn.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+
+    def pages_size(self, conn=None):
+        """
+        Bytes of the HTML pages kept by the page cache
+        """
+        if conn is None:
+            conn = self.connection()
+        return conn.execute("SELECT value FROM meta WHERE name = 'pages_size'").fetchone()[0]
+
+    def evict(self, max_size):
+        """
+        Remove entries following the eviction policy until the cache fits in `max_size`.
+        The HTML pages of the page cache count toward `max_size` too, they are
+        removed oldest first once there is no file left to remove.
+
+        :return: (number of files and pages, number of bytes) removed
+        """
+        removed = list()
+        freed = 0
+        pages_removed = 0
+        with self.transaction() as conn:
+            total = self.total_size(conn)
+            pages = self.pages_size(conn)
+            query = 'SELECT digest, size FROM blobs ORDER BY {} LIMIT 256'.format(EVICTION_ORDER[self.policy])
+            while total + pages > max_size:
+                rows = conn.execute(query).fetchall()
+                if len(rows) == 0:
+                    break
+                for digest, size in rows:
+                    if total + pages <= max_size:
+                        break
+                    conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                    conn.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+                    total -= size
+                    freed += size
+                    removed.append(digest)
+            conn.execute("UPDATE meta SET value = ? WHERE name = 'total_size'", (max(total, 0),))
+
+            if total + pages > max_size:
+                for key, size in conn.execute('SELECT key, LENGTH(body) FROM pages ORDER BY fetched').fetchall():
+                    if total + pages <= max_size:
+                        break
+                    conn.execute('DELETE FROM pages WHERE key = ?', (key,))
+                    pages -= size
+                    freed += size
+                    pages_removed += 1
+                conn.execute("UPDATE meta SET value = ? WHERE name = 'pages_size'", (max(pages, 0),))
+
+        for digest in removed:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+        return len(removed) + pages_removed, freed
+
+    def stats(self):
+        conn = self.connection()
+        blobs, size, oldest, newest = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_access), MAX(last_access) FROM blobs').fetchone()
+        urls = conn.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+        return {
+            'files': blobs,
+            'urls': urls,
+            'size': size,
+            'max_size': self.max_size,
+            'policy': self.policy,
+            'oldest_access': oldest,
+            'newest_access': newest
+        }
+
+    def iter_legacy(self):
+        """
+        Yield the url keys of files still stored in the legacy layout
+        """
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root)
+            if rel == os.curdir:
+                dirnames[:] = [d for d in dirnames if re.match(r"^[0-9a-f]{8}$", d)]
+                continue
+            for filename in filenames:
+                key = str.join('', rel.split(os.path.sep) + [filename])
+                if re.match(r"^[0-9a-f]{40}$", key):
+                    yield key
+
+    def migrate(self):
+        """
+        Import every legacy file into the index
+
+        :return: number of files imported
+        """
+        count = 0
+        for key in list(self.iter_legacy()):
+            if self.adopt(key) is not None:
+                count += 1
+
+        # remove the now empty legacy directories
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            rel = os.path.relpath(dirpath, self.root)
+            if rel != os.curdir and re.match(r"^[0-9a-f]{8}$", rel.split(os.path.sep)[0]):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return count
+
+    def verify(self, repair=False, deep=False):
+        """
+        Check the index against the files on disk
+
+        :param repair: Fix the problems found
+        :param deep: Re-hash every file and HTML page to detect corruption
+        :return: dict of problem counts
+        """
+        report = {'checked': 0, 'missing': 0, 'corrupt': 0, 'orphans': 0}
+        conn = self.connection()
+        known = set()
+
+        for digest, size in conn.execute('SELECT digest, size FROM blobs').fetchall():
+            report['checked'] += 1
+            path = self.object_path(digest)
+            if not os.path.exists(path):
+                report['missing'] += 1
+                if repair:
+                    self.forget(digest)
+                continue
+
+            known.add(digest)
+            if os.path.getsize(path) != size or (deep and hash_file(path)[0] != digest):
+                report['corrupt'] += 1
+                if repair:
+                    self.forget(digest)
+                    os.remove(path)
+
+        objects = os.path.join(self.root, 'objects')
+        for dirpath, dirnames, filenames in os.walk(objects):
+            for filename in filenames:
+                if filename not in known:
+                    report['orphans'] += 1
+                    if repair:
+                        os.remove(os.path.join(dirpath, filename))
+
+        if deep:
+            for key, digest, body in conn.execute('SELECT key, digest, body FROM pages').fetchall():
+                try:
+                    valid = hashlib.sha1(zlib.decompress(body)).hexdigest() == digest
+                except zlib.error:
+                    valid = False
+                if not valid:
+                    report['corrupt'] += 1
+                    if repair:
+                        self.forget_page(key)
+
+        if repair:
+            shutil.rmtree(os.path.join(self.root, 'tmp'), ignore_errors=True)
+            with self.transaction() as conn:
+                conn.execute('DELETE FROM urls WHERE digest NOT IN (SELECT digest FROM blobs)')
+                conn.execute("UPDATE meta SET value = (SELECT COALESCE(SUM(size), 0) FROM blobs) WHERE name = 'total_size'")
+                conn.execute("UPDATE meta SET value = (SELECT COALESCE(SUM(LENGTH(body)), 0) FROM pages) "
+                             "WHERE name = 'pages_size'")
+            if self.max_size is not None:
+                self.evict(self.max_size)
+
+        return report
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    size = 0
+    with open(path, mode='rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class PageCache(object):
+    """
+    HTML responses of the sites, stored with their validators in the index
+    of the image cache
+
+    A page younger than the TTL of its kind is used as is, an older one is
+    revalidated with a conditional request and reused on a 304.
+    """
+
+    def __init__(self, cache, ttls=None, enabled=True):
+        """
+        :param cache: ImageCache holding the index
+        """
+        self.cache = cache
+        self.configure(ttls, enabled)
+
+    def configure(self, ttls=None, enabled=True):
+        """
+        :param ttls: dict of TTL in seconds by kind of page (see PAGE_TTLS)
+        :param enabled: False to always fetch pages in full
+        """
+        self.ttls = dict(PAGE_TTLS)
+        for kind, ttl in (ttls or {}).items():
+            if kind not in PAGE_TTLS:
+                raise ValueError("Unknown kind of page {}".format(kind))
+            if ttl is not None:
+                self.ttls[kind] = ttl
+        self.enabled = enabled
+
+    def lookup(self, url):
+        """
+        :return: dict with etag, last_modified, content_type, digest, fetched and body, or None
+        """
+        conn = self.cache.connection()
+        row = conn.execute('SELECT etag, last_modified, content_type, digest, fetched, body FROM pages WHERE key = ?',
+                           (url_key(url),)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_type, digest, fetched, body = row
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_type': content_type,
+            'digest': digest,
+            'fetched': fetched,
+            'body': zlib.decompress(body),
+        }
+
+    def is_fresh(self, entry, kind):
+        return time.time() - entry['fetched'] < self.ttls[kind]
+
+    def validators(self, entry):
+        """
+        Headers of a conditional request for a cached page
+        """
+        headers = dict()
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, resp):
+        """
+        Cache a page from its 200 response
+
+        :return: digest of the body
+        """
+        body = resp.content
+        digest = hashlib.sha1(body).hexdigest()
+        compressed = zlib.compress(body)
+        key = url_key(url)
+        with self.cache.transaction() as conn:
+            row = conn.execute('SELECT LENGTH(body) FROM pages WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO pages (key, url, etag, last_modified, content_type, digest, fetched, body) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'),
+                          resp.headers.get('Content-Type'), digest, time.time(), compressed))
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'pages_size'",
+                         (len(compressed) - (row[0] if row is not None else 0),))
+
+        # pages count toward the budget of the image cache
+        if self.cache.max_size is not None:
+            self.cache.evict(self.cache.max_size)
+        return digest
+
+    def touch(self, url, resp):
+        """
+        Mark a cached page as fresh after a 304, keeping the validators the
+        server sent with it
+        """
+        with self.cache.transaction() as conn:
+            conn.execute('UPDATE pages SET fetched = ?, etag = COALESCE(?, etag), '
+                         'last_modified = COALESCE(?, last_modified) WHERE key = ?',
+                         (time.time(), resp.headers.get('ETag'), resp.headers.get('Last-Modified'), url_key(url)))
+
+    def stats(self):
+        conn = self.cache.connection()
+        pages = conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+        return {'pages': pages, 'size': self.cache.pages_size(conn)}
+
+
+image_cache = ImageCache()
+page_cache = PageCache(image_cache)
@@ -0,0 +1,118 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.111 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, sdch',
+    'Accept-Language': 'en-US,en;q=0.8,fr;q=0.6',
+    'Cache-Control': 'max-age=0',
+    'Connection': 'keep-alive'
+}
+
+
+class HttpClient(object):
+    """
+    Shared HTTP client keeping a pool of keep-alive connections per host
+
+    The session is thread-safe (urllib3 pools are locked) and is re-created
+    after a fork so worker processes never share sockets with their parent.
+    """
+
+    def __init__(self, pool_size=10, timeout=30):
+        """
+        :param pool_size: Maximum number of connections kept per host
+        :param timeout: Connect/read timeout in seconds
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.requests = 0
+        self._session = None
+
+    def make_session(self):
+        # nothing is retried here, failed requests are left to the scheduler which paces the host
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size,
+                              max_retries=0)
+        session = requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session(self):
+        pid = os.getpid()
+        with self.lock:
+            if self._session is None or self.pid != pid:
+                self._session = self.make_session()
+                self.pid = pid
+                self.requests = 0
+            return self._session
+
+    def request(self, method, url, **kwargs):
+        session = self.session()
+        kwargs.setdefault('timeout', self.timeout)
+        with self.lock:
+            self.requests += 1
+        return session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        """
+        Close the pooled connections, the counters start over with the next session
+        """
+        with self.lock:
+            if self._session is not None and self.pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self.requests = 0
+
+    def stats(self):
+        """
+        Connection reuse counters for the current process
+
+        :return: dict with requests, connections and reused counts
+        """
+        connections = 0
+        with self.lock:
+            session = self._session if self.pid == os.getpid() else None
+            requests_count = self.requests
+
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+
+        return {
+            'requests': requests_count,
+            'connections': connections,
+            'reused': max(requests_count - connections, 0)
+        }
+
+
+client = HttpClient()
+
+
+def configure(pool_size=None, timeout=None):
+    """
+    Change the settings of the shared client, unset values are left as is
+    (used as a Pool initializer for worker processes)
+    """
+    client.close()
+    if pool_size is not None:
+        client.pool_size = pool_size
+    if timeout is not None:
+        client.timeout = timeout
@@ -1,5 +1,14 @@
+import sys
+from array import array
+
+
+# url suffixes up to this length are interned
+INTERN_SUFFIX_LENGTH = 24
+
 
 class Metadata(object):
+    __slots__ = ('title', 'slug', 'cover_url')
+
     def __init__(self, title, slug):
         self.title = title
         self.slug = slug
@@ -7,6 +16,8 @@ class Metadata(object):
 
 
 class Volume(object):
+    __slots__ = ('number', 'chapters')
+
     def __init__(self, number):
         self.number = number
         self.chapters = list()
@@ -19,12 +30,14 @@ class Volume(object):
 
 
 class Chapter(object):
+    __slots__ = ('url', 'title', 'number', 'volume', 'pages')
+
     def __init__(self, url, title, number, volume=None):
         self.url = url
         self.title = title
         self.number = number
         self.volume = volume
-        self.pages = list()
+        self.pages = PageTable()
 
     def add_page(self, page):
         self.pages.append(page)
@@ -38,6 +51,8 @@ class Chapter(object):
 
 
 class Page(object):
+    __slots__ = ('url', 'number', 'image_url')
+
     def __init__(self, url, number, image_url=None):
         self.url = url
         self.image_url = image_url
@@ -45,3 +60,123 @@ class Page(object):
 
     def __repr__(self):
         return r"Page(url='{}', number={}, image_url='{}')".format(self.url, self.number, self.image_url)
+
+
+class PageTable(object):
+    """
+    Compact list of the pages of a chapter
+
+    Page numbers are kept in an array and urls are split into a prefix,
+    interned and shared by the pages, and a suffix. Short suffixes such as
+    "k001.jpg" repeat in every chapter and are interned as well. Items are
+    `PageRef` views with the same attributes as `Page`, writing through to
+    the table.
+    """
+    __slots__ = ('numbers', 'prefixes', 'url_prefixes', 'url_suffixes', 'image_prefixes', 'image_suffixes')
+
+    def __init__(self, pages=()):
+        self.numbers = array('l')
+        # prefix 0 stands for a missing url
+        self.prefixes = [None]
+        self.url_prefixes = array('I')
+        self.url_suffixes = list()
+        self.image_prefixes = array('I')
+        self.image_suffixes = list()
+        for page in pages:
+            self.append(page)
+
+    def pack(self, url):
+        if url is None:
+            return 0, None
+        split = url.rfind('/') + 1
+        prefix, suffix = url[:split], url[split:]
+        if len(suffix) <= INTERN_SUFFIX_LENGTH:
+            suffix = sys.intern(suffix)
+        try:
+            return self.prefixes.index(prefix, 1), suffix
+        except ValueError:
+            self.prefixes.append(sys.intern(prefix))
+            return len(self.prefixes) - 1, suffix
+
+    def unpack(self, prefix, suffix):
+        if prefix == 0:
+            return None
+        return self.prefixes[prefix] + suffix
+
+    def append(self, page):
+        self.numbers.append(int(page.number))
+        prefix, suffix = self.pack(page.url)
+        self.url_prefixes.append(prefix)
+        self.url_suffixes.append(suffix)
+        prefix, suffix = self.pack(page.image_url)
+        self.image_prefixes.append(prefix)
+        self.image_suffixes.append(suffix)
+
+    def get_url(self, index):
+        return self.unpack(self.url_prefixes[index], self.url_suffixes[index])
+
+    def set_url(self, index, url):
+        self.url_prefixes[index], self.url_suffixes[index] = self.pack(url)
+
+    def get_image_url(self, index):
+        return self.unpack(self.image_prefixes[index], self.image_suffixes[index])
+
+    def set_image_url(self, index, url):
+        self.image_prefixes[index], self.image_suffixes[index] = self.pack(url)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PageRef(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("page index out of range")
+        return PageRef(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield PageRef(self, index)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PageRef(object):
+    """
+    Page stored in a `PageTable`
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def number(self):
+        return self.table.numbers[self.index]
+
+    @number.setter
+    def number(self, number):
+        self.table.numbers[self.index] = int(number)
+
+    @property
+    def url(self):
+        return self.table.get_url(self.index)
+
+    @url.setter
+    def url(self, url):
+        self.table.set_url(self.index, url)
+
+    @property
+    def image_url(self):
+        return self.table.get_image_url(self.index)
+
+    @image_url.setter
+    def image_url(self, url):
+        self.table.set_image_url(self.index, url)
+
+    def __repr__(self):
+        return r"Page(url='{}', number={}, image_url='{}')".format(self.url, self.number, self.image_url)
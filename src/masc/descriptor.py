@@ -1,7 +1,456 @@
+import os
+import re
+import json
+import mmap
+import hashlib
+import sqlite3
+import errno
+from urllib.request import pathname2url
+from collections.abc import MutableMapping
 from xml.etree import ElementTree
 from masc.data import *
 
 
+def metadata_from_element(elem):
+    metadata = Metadata(title=str(elem.find('title').text),
+                        slug=str(elem.get('slug')))
+    cover_tag = elem.find('cover')
+    metadata.cover_url = str(cover_tag.get('url', cover_tag.text))
+    return metadata
+
+
+def chapter_from_element(elem, volume_number):
+    chapter = Chapter(url=str(elem.get('url')),
+                      title=str(elem.find('title').text),
+                      number=str(elem.get('number')))
+    chapter.volume = volume_number
+
+    for page_tag in elem.findall('page'):
+        page = Page(url=None,
+                    number=int(page_tag.get('number')))
+        page.image_url = str(page_tag.get('url'))
+        chapter.add_page(page)
+
+    return chapter
+
+
+class XmlSource(object):
+    """
+    Random access to the volumes of an XML descriptor
+
+    The byte range of each volume is found once by scanning the file for
+    the tags, and kept in a <descriptor>.idx file next to it for as long
+    as the descriptor is unchanged. Volumes are parsed from the memory
+    mapped file when requested.
+    """
+
+    TAG = re.compile(rb"<(metadata|volume)\b[^>]*?(/?)>")
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.fp = open(path, mode='rb')
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = index or self.read_index() or self.build_index()
+        self.ranges = dict((number, (start, end)) for number, start, end in self.index['volumes'])
+
+    def __getstate__(self):
+        # worker processes map the file again instead of receiving its content
+        return {'path': self.path, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index'])
+
+    def index_path(self):
+        return "{}.idx".format(self.path)
+
+    def stat(self):
+        stat = os.fstat(self.fp.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def read_index(self):
+        try:
+            with open(self.index_path(), mode='r') as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if index.get('stat') != list(self.stat()):
+            return None
+        return index
+
+    def build_index(self):
+        index = {'stat': list(self.stat()), 'metadata': None, 'volumes': list()}
+        pos = 0
+        while True:
+            match = self.TAG.search(self.data, pos)
+            if match is None:
+                break
+
+            tag, self_closing = match.group(1), match.group(2)
+            if self_closing:
+                end = match.end()
+            else:
+                closing = b'</' + tag + b'>'
+                end = self.data.find(closing, match.end())
+                if end < 0:
+                    raise RuntimeError("{}: unclosed {} tag".format(self.path, tag.decode()))
+                end += len(closing)
+
+            if tag == b'metadata':
+                index['metadata'] = [match.start(), end]
+            else:
+                start_tag = match.group(0) if self_closing else match.group(0) + b'</volume>'
+                number = str(ElementTree.fromstring(start_tag).get('number'))
+                index['volumes'].append([number, match.start(), end])
+            pos = end
+
+        if index['metadata'] is None:
+            raise RuntimeError("{} does not contain metadata".format(self.path))
+
+        try:
+            with open(self.index_path(), mode='w') as fp:
+                json.dump(index, fp)
+        except OSError:
+            pass
+        return index
+
+    def element(self, start, end):
+        return ElementTree.fromstring(self.data[start:end])
+
+    def metadata(self):
+        return metadata_from_element(self.element(*self.index['metadata']))
+
+    def numbers(self):
+        return [number for number, start, end in self.index['volumes']]
+
+    def raw(self, number):
+        start, end = self.ranges[number]
+        return self.data[start:end]
+
+    def load_volume(self, number):
+        volume = Volume(number=number)
+        for chapter_tag in self.element(*self.ranges[number]).findall('chapter'):
+            volume.add_chapter(chapter_from_element(chapter_tag, number))
+        volume.chapters.sort(key=lambda x: float(x.number))
+        return volume
+
+    def summary(self, number):
+        return [(str(chapter_tag.get('number')), str(chapter_tag.find('title').text), len(chapter_tag.findall('page')))
+                for chapter_tag in self.element(*self.ranges[number]).findall('chapter')]
+
+    def close(self):
+        self.data.close()
+        self.fp.close()
+
+
+class XmlBackend(object):
+    """
+    Descriptor stored as XML, read with iterparse one chapter at a time
+    and written one volume at a time
+    """
+
+    @staticmethod
+    def open(path):
+        return XmlSource(path)
+
+    @staticmethod
+    def read_metadata(path):
+        for event, elem in ElementTree.iterparse(path, events=('end',)):
+            if elem.tag == 'metadata':
+                return metadata_from_element(elem)
+        raise RuntimeError("{} does not contain metadata".format(path))
+
+    @staticmethod
+    def iter_chapters(path):
+        volume_number = None
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'volume':
+                    volume_number = str(elem.get('number'))
+                continue
+
+            if elem.tag == 'chapter':
+                yield chapter_from_element(elem, volume_number)
+                elem.clear()
+            elif elem.tag == 'volume':
+                elem.clear()
+
+    @staticmethod
+    def write(path, descriptor):
+        volumes = descriptor.volumes
+        with open(path, mode='wb') as fp:
+            fp.write(b'<descriptor>')
+
+            metadata_tag = ElementTree.Element('metadata')
+            metadata_tag.set('slug', descriptor.metadata.slug)
+            title_tag = ElementTree.SubElement(metadata_tag, 'title')
+            title_tag.text = str(descriptor.metadata.title)
+            cover_tag = ElementTree.SubElement(metadata_tag, 'cover')
+            cover_tag.set('url', str(descriptor.metadata.cover_url))
+            fp.write(ElementTree.tostring(metadata_tag))
+
+            for vid in list(volumes.keys()):
+                if isinstance(volumes, LazyVolumes) and not volumes.is_loaded(vid) and isinstance(volumes.source, XmlSource):
+                    # untouched volumes are copied as they are
+                    fp.write(volumes.source.raw(vid))
+                    continue
+
+                volume = volumes[vid]
+                volume_tag = ElementTree.Element('volume')
+                volume_tag.set('number', str(vid))
+                for chapter in volume.chapters:
+                    chapter_tag = ElementTree.SubElement(volume_tag, 'chapter')
+                    chapter_tag.set('number', str(chapter.number))
+                    chapter_tag.set('url', str(chapter.url))
+
+                    title_tag = ElementTree.SubElement(chapter_tag, 'title')
+                    title_tag.text = str(chapter.title)
+
+                    for page in chapter.pages:
+                        page_tag = ElementTree.SubElement(chapter_tag, 'page')
+                        page_tag.set('number', str(page.number))
+                        page_tag.set('url', str(page.image_url))
+
+                fp.write(ElementTree.tostring(volume_tag))
+
+            fp.write(b'</descriptor>')
+
+
+class SqliteSource(object):
+    """
+    Random access to the volumes of a SQLite descriptor
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def metadata(self):
+        return SqliteBackend.read_metadata(self.path)
+
+    def numbers(self):
+        conn = SqliteBackend.connect(self.path)
+        try:
+            return [number for number, in conn.execute('SELECT number FROM volumes ORDER BY position')]
+        finally:
+            conn.close()
+
+    def load_volume(self, number):
+        conn = SqliteBackend.connect(self.path)
+        try:
+            volume = Volume(number=number)
+            for chapter in SqliteBackend.chapters(conn, 'WHERE c.volume = ?', (number,)):
+                volume.add_chapter(chapter)
+        finally:
+            conn.close()
+        volume.chapters.sort(key=lambda x: float(x.number))
+        return volume
+
+    def summary(self, number):
+        conn = SqliteBackend.connect(self.path)
+        try:
+            return conn.execute('SELECT c.number, c.title, COUNT(p.number) FROM chapters c '
+                                'LEFT JOIN pages p ON p.volume = c.volume AND p.chapter = c.number '
+                                'WHERE c.volume = ? GROUP BY c.volume, c.number ORDER BY c.rowid', (number,)).fetchall()
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class SqliteBackend(object):
+    """
+    Descriptor stored as a SQLite database, saving over an existing file
+    only rewrites the chapters that changed
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS volumes (
+        number TEXT PRIMARY KEY,
+        position INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS chapters (
+        volume TEXT NOT NULL,
+        number TEXT NOT NULL,
+        url TEXT,
+        title TEXT,
+        fingerprint TEXT NOT NULL,
+        PRIMARY KEY (volume, number)
+    );
+    CREATE TABLE IF NOT EXISTS pages (
+        volume TEXT NOT NULL,
+        chapter TEXT NOT NULL,
+        number INTEGER NOT NULL,
+        url TEXT,
+        image_url TEXT,
+        PRIMARY KEY (volume, chapter, number)
+    );
+    """
+
+    @staticmethod
+    def open(path):
+        return SqliteSource(path)
+
+    @staticmethod
+    def connect(path, write=False):
+        """
+        :param write: Create the file and its tables if missing, it is opened read only otherwise
+        """
+        if not write:
+            if not os.path.exists(path):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(path))), uri=True)
+        conn = sqlite3.connect(path)
+        conn.executescript(SqliteBackend.SCHEMA)
+        return conn
+
+    @staticmethod
+    def fingerprint(chapter):
+        digest = hashlib.sha1()
+        digest.update(repr((chapter.url, chapter.title)).encode('utf-8'))
+        for page in chapter.pages:
+            digest.update(repr((page.number, page.url, page.image_url)).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def read_metadata(path):
+        conn = SqliteBackend.connect(path)
+        try:
+            values = dict(conn.execute('SELECT key, value FROM metadata'))
+        except sqlite3.DatabaseError:
+            values = dict()
+        finally:
+            conn.close()
+        if 'slug' not in values:
+            raise RuntimeError("{} does not contain metadata".format(path))
+        metadata = Metadata(title=values.get('title'), slug=values['slug'])
+        metadata.cover_url = values.get('cover_url')
+        return metadata
+
+    @staticmethod
+    def chapters(conn, where='', params=()):
+        chapters = conn.execute('SELECT c.volume, c.number, c.url, c.title '
+                                'FROM chapters c JOIN volumes v ON v.number = c.volume {} '
+                                'ORDER BY v.position, c.rowid'.format(where), params)
+        for volume, number, url, title in chapters:
+            chapter = Chapter(url=url, title=title, number=number, volume=volume)
+            pages = conn.execute('SELECT number, url, image_url FROM pages '
+                                 'WHERE volume = ? AND chapter = ? ORDER BY number', (volume, number))
+            for page_number, page_url, image_url in pages:
+                chapter.add_page(Page(url=page_url, number=page_number, image_url=image_url))
+            yield chapter
+
+    @staticmethod
+    def iter_chapters(path):
+        conn = SqliteBackend.connect(path)
+        try:
+            for chapter in SqliteBackend.chapters(conn):
+                yield chapter
+        finally:
+            conn.close()
+
+    @staticmethod
+    def write(path, descriptor):
+        volumes = descriptor.volumes
+        # volumes not loaded from this very file are already stored as they are
+        untouched = set()
+        if isinstance(volumes, LazyVolumes) and isinstance(volumes.source, SqliteSource) \
+                and os.path.exists(path) and os.path.samefile(path, volumes.source.path):
+            untouched = set(vid for vid in volumes.keys() if not volumes.is_loaded(vid))
+
+        conn = SqliteBackend.connect(path, write=True)
+        try:
+            with conn:
+                metadata = descriptor.metadata
+                conn.executemany('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',
+                                 [('slug', metadata.slug), ('title', metadata.title), ('cover_url', metadata.cover_url)])
+
+                conn.execute('DELETE FROM volumes')
+                conn.executemany('INSERT INTO volumes (number, position) VALUES (?, ?)',
+                                 [(str(vid), position) for position, vid in enumerate(volumes.keys())])
+
+                existing = dict(((volume, number), fingerprint) for volume, number, fingerprint
+                                in conn.execute('SELECT volume, number, fingerprint FROM chapters')
+                                if volume not in untouched)
+                for vid in volumes.keys():
+                    if vid in untouched:
+                        continue
+                    for chapter in volumes[vid].chapters:
+                        key = (str(vid), str(chapter.number))
+                        fingerprint = SqliteBackend.fingerprint(chapter)
+                        if existing.pop(key, None) == fingerprint:
+                            continue
+
+                        conn.execute('DELETE FROM pages WHERE volume = ? AND chapter = ?', key)
+                        conn.execute('INSERT OR REPLACE INTO chapters (volume, number, url, title, fingerprint) '
+                                     'VALUES (?, ?, ?, ?, ?)', key + (chapter.url, chapter.title, fingerprint))
+                        conn.executemany('INSERT INTO pages (volume, chapter, number, url, image_url) '
+                                         'VALUES (?, ?, ?, ?, ?)',
+                                         [key + (page.number, page.url, page.image_url) for page in chapter.pages])
+
+                # chapters no longer in the descriptor
+                for key in existing.keys():
+                    conn.execute('DELETE FROM pages WHERE volume = ? AND chapter = ?', key)
+                    conn.execute('DELETE FROM chapters WHERE volume = ? AND number = ?', key)
+        finally:
+            conn.close()
+
+
+BACKENDS = {
+    '.xml': XmlBackend,
+    '.db': SqliteBackend,
+    '.sqlite': SqliteBackend
+}
+
+
+def get_backend(path):
+    _, ext = os.path.splitext(path)
+    return BACKENDS.get(ext.lower(), XmlBackend)
+
+
+class LazyVolumes(MutableMapping):
+    """
+    Volumes of a descriptor, each one is only read from the source the
+    first time it is accessed
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.numbers = source.numbers()
+        self.loaded = dict()
+
+    def is_loaded(self, number):
+        return number in self.loaded
+
+    def __getitem__(self, number):
+        if number not in self.loaded:
+            if number not in self.numbers:
+                raise KeyError(number)
+            self.loaded[number] = self.source.load_volume(number)
+        return self.loaded[number]
+
+    def __setitem__(self, number, volume):
+        if number not in self.numbers:
+            self.numbers.append(number)
+        self.loaded[number] = volume
+
+    def __delitem__(self, number):
+        self.numbers.remove(number)
+        self.loaded.pop(number, None)
+
+    def __contains__(self, number):
+        return number in self.numbers
+
+    def __iter__(self):
+        return iter(list(self.numbers))
+
+    def __len__(self):
+        return len(self.numbers)
+
+
 class Descriptor(object):
     def __init__(self):
         self.metadata = None
@@ -10,65 +459,64 @@ class Descriptor(object):
     def add_volume(self, volume):
         self.volumes[volume.number] = volume
 
+    def summary(self, number):
+        """
+        List the chapters of a volume without creating their pages
+
+        :param number: Volume number
+        :return: [(chapter number, title, page count)]
+        """
+        if isinstance(self.volumes, LazyVolumes) and not self.volumes.is_loaded(number):
+            return self.volumes.source.summary(number)
+        return [(chapter.number, chapter.title, len(chapter.pages)) for chapter in self.volumes[number].chapters]
+
     @staticmethod
-    def load(path):
-        self = Descriptor()
-        xml = ElementTree.parse(path)
-        root = xml.getroot()
+    def iter_chapters(path):
+        """
+        Stream the chapters of a descriptor file without loading it whole
 
-        metadata_tag = root.find('metadata')
-        self.metadata = Metadata(title=str(metadata_tag.find('title').text),
-                                 slug=str(metadata_tag.get('slug')))
-        self.metadata.cover_url = str(metadata_tag.find('cover').text)
+        :param path: Descriptor file (.xml or .db)
+        :return: iterator of Chapter
+        """
+        return get_backend(path).iter_chapters(path)
 
-        for volume_tag in root.findall('volume'):
-            volume = Volume(number=str(volume_tag.get('number')))
+    @staticmethod
+    def open(path):
+        """
+        Open a descriptor without reading its volumes, they are loaded
+        when first accessed
 
-            for chapter_tag in volume_tag.findall('chapter'):
-                chapter = Chapter(url=str(chapter_tag.get('url')),
-                                  title=str(chapter_tag.find('title').text),
-                                  number=str(chapter_tag.get('number')))
-                chapter.volume = volume.number
+        :param path: Descriptor file (.xml or .db)
+        :return: Descriptor
+        """
+        source = get_backend(path).open(path)
+        self = Descriptor()
+        self.metadata = source.metadata()
+        self.volumes = LazyVolumes(source)
+        return self
 
-                for page_tag in chapter_tag.findall('page'):
-                    page = Page(url=None,
-                                number=int(page_tag.get('number')))
-                    page.image_url = str(page_tag.get('url'))
-                    chapter.add_page(page)
+    @staticmethod
+    def load(path):
+        self = Descriptor()
+        backend = get_backend(path)
+        self.metadata = backend.read_metadata(path)
 
-                volume.add_chapter(chapter)
+        for chapter in backend.iter_chapters(path):
+            if chapter.volume not in self.volumes:
+                self.add_volume(Volume(number=chapter.volume))
+            self.volumes[chapter.volume].add_chapter(chapter)
 
+        for volume in self.volumes.values():
             volume.chapters.sort(key=lambda x: float(x.number))
 
-            self.add_volume(volume)
-
         return self
 
     def save(self, path):
-        descriptor = ElementTree.Element('descriptor')
-
-        metadata_tag = ElementTree.SubElement(descriptor, 'metadata')
-        metadata_tag.set('slug', self.metadata.slug)
-        title_tag = ElementTree.SubElement(metadata_tag, 'title')
-        title_tag.text = str(self.metadata.title)
-        cover_tag = ElementTree.SubElement(metadata_tag, 'cover')
-        cover_tag.set('url', self.metadata.cover_url)
-
-        for vid, volume in self.volumes.items():
-            volume_tag = ElementTree.SubElement(descriptor, 'volume')
-            volume_tag.set('number', str(vid))
-            for chapter in volume.chapters:
-                chapter_tag = ElementTree.SubElement(volume_tag, 'chapter')
-                chapter_tag.set('number', str(chapter.number))
-                chapter_tag.set('url', str(chapter.url))
-
-                title_tag = ElementTree.SubElement(chapter_tag, 'title')
-                title_tag.text = str(chapter.title)
-
-                for page in chapter.pages:
-                    page_tag = ElementTree.SubElement(chapter_tag, 'page')
-                    page_tag.set('number', str(page.number))
-                    page_tag.set('url', str(page.image_url))
-
-        tree = ElementTree.ElementTree(descriptor)
-        tree.write(path)
+        backend = get_backend(path)
+        if backend is XmlBackend:
+            # never leave a half written descriptor behind
+            tmp_path = "{}.tmp".format(path)
+            backend.write(tmp_path, self)
+            os.replace(tmp_path, path)
+        else:
+            backend.write(path, self)
@@ -0,0 +1,78 @@
+import re
+import threading
+from lxml import etree, html
+
+
+def has_class(name):
+    """
+    XPath predicate matching elements with the CSS class `name`
+    """
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+
+class Selector(object):
+    """
+    Compiled XPath expression, declared once per adapter class and
+    evaluated against the raw lxml tree of a page
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.xpath = etree.XPath(expr)
+
+    def all(self, tree):
+        return self.xpath(tree)
+
+    def first(self, tree, default=None):
+        result = self.xpath(tree)
+        if len(result) == 0:
+            return default
+        return result[0]
+
+    def text(self, tree, default=None):
+        """
+        Text content of the first match
+        """
+        node = self.first(tree)
+        if node is None:
+            return default
+        if isinstance(node, str):
+            return str(node).strip()
+        return node.text_content().strip()
+
+    def __repr__(self):
+        return "Selector({!r})".format(self.expr)
+
+
+def charset(content_type):
+    """
+    Charset declared in a Content-Type header, None if there is none
+    """
+    match = re.search(r"charset=[\"']?([\w.:-]+)", content_type or '', re.IGNORECASE)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# lxml parsers must not be shared between threads
+_local = threading.local()
+
+
+def parse_html(content, encoding=None):
+    """
+    Parse a page into an lxml tree
+
+    :param content: Page as bytes or str
+    :param encoding: Encoding of `content` (default: read from the document)
+    :return: lxml.html.HtmlElement
+    """
+    if encoding is None or isinstance(content, str):
+        return html.fromstring(content)
+
+    parsers = getattr(_local, 'parsers', None)
+    if parsers is None:
+        parsers = _local.parsers = dict()
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = html.HTMLParser(encoding=encoding)
+    return html.fromstring(content, parser=parser)
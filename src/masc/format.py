@@ -1,102 +1,487 @@
 from masc.scraper import *
-from masc.util import fetch_cached, FetchError
-# from ebooklib import epub
-from zipfile import ZipFile
+from masc.util import fetch_cached, stream_cached, prefetch_cached, head_cached, ordered_map, FetchError
+from masc.transform import transform_cached, transform_failed, image_extension
+from masc.metrics import metrics
+from masc.archive import copy_entry, write_raw_entry, entry_source, EntryCompressor, Journal, resume_archive
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+import re
+import shutil
+import time
+import requests
+from xml.sax.saxutils import escape, quoteattr
 
 
-# def ebook(adapter):
-#     return EbookAdapter(adapter)
+def ebook(adapter):
+    return EbookAdapter(adapter)
 
 
 def cbz(adapter):
     return ArchiveAdapter(adapter)
 
 
-# class EbookAdapter(FormatAdapter):
-#     def file_format(self):
-#         return '.epub'
-#
-#     def build_volume(self, filename, volume, metadata):
-#         book = epub.EpubBook()
-#         book.set_identifier("{}-v{:0>2s}".format(metadata.slug, volume.number))
-#         book_title = "Volume {} - {}".format(volume.number, metadata.title)
-#         book.set_title(book_title)
-#         # ebook.set_cover('cover.jpg', fetch_image(self.cover_url))
-#
-#         spine_chapters = []
-#         sorted_chapters = sorted(volume.chapters, key=lambda chap: chap.number)
-#         # pprint(sorted_chapters)
-#         for chapter in sorted_chapters:
-#             eb_chapter, images = self.build_chapter(chapter)
-#             book.add_item(eb_chapter)
-#             for_each(images, book.add_item)
-#             spine_chapters.append(eb_chapter)
-#
-#         book.add_item(epub.EpubNav())
-#
-#         book.toc = [epub.Section('Chapters')] + spine_chapters
-#         book.spine = ['nav'] + spine_chapters
-#
-#         epub.write_epub(filename, book)
-#
-#     def build_chapter(self, chapter):
-#         """
-#         Create the epub objects and downloads images
-#
-#         :param chapter: Chapter to build from
-#         :return: EpubHtml, [EpubImage]
-#         """
-#         print("{} - {}: {} ({} pages)".format(chapter.volume, chapter.number, chapter.title, len(chapter.pages)))
-#         chap = epub.EpubHtml()
-#         chap.title = chapter.title
-#         chap.file_name = 'chap-%s.html' % chapter.number
-#         chap_html = list()
-#         images = list()
-#
-#         sorted_pages = sorted(chapter.pages, key=lambda p: p.number)
-#         # pprint(sorted_pages)
-#         for page in sorted_pages:
-#             img = epub.EpubImage()
-#             img.file_name = 'ch{0!s:0>3s}-p{1!s:0>3s}.jpg'.format(chapter.number, page.number)
-#             if page.image_url is None:
-#                 page.image_url = self.adapter.get_image(page)
-#             img.content = fetch_cached(page.image_url)
-#             chap_html.append('<img src="{}" />'.format(img.file_name))
-#             images.append(img)
-#
-#         chap.content = str.join("\n", chap_html)
-#         return chap, images
+# page entries as named by `page_stem`, or as renamed by `masc fix` (see main.fix_name)
+PAGE_PATTERN = re.compile(r"^(?P<prefix>.*?)ch(?P<chap>[^/]+)-p(?P<page>\d+)$")
+
+
+def stem_key(stem):
+    """
+    Key pages are matched on, the same for a page whatever the padding of
+    its chapter and page numbers
+
+    :param stem: Entry name without its extension
+    """
+    match = PAGE_PATTERN.match(stem)
+    if match is not None:
+        try:
+            return match.group('prefix'), float(match.group('chap')), int(match.group('page'))
+        except ValueError:
+            pass
+    return stem
+
+
+def entry_key(name):
+    """
+    Key of an entry, names always carry an extension
+    """
+    return stem_key(os.path.splitext(name)[0])
 
 
 class ArchiveAdapter(FormatAdapter):
     def file_format(self):
         return '.cbz'
 
-    def build_volume(self, filename, volume, metadata):
+    def fetch_page(self, page):
+        """
+        Resolve the image url of a page and download it into the cache
+        ahead of the writer. An image url that fails, as a url guessed by
+        `SiteAdapter.get_images` may, is resolved again from the page.
+        """
+        if page.image_url is None:
+            page.image_url = self.adapter.get_image(page)
+        try:
+            prefetch_cached(page.image_url)
+        except FetchError:
+            image_url = self.adapter.get_image(page)
+            if image_url == page.image_url:
+                raise
+            page.image_url = image_url
+            prefetch_cached(page.image_url)
+        return page
+
+    def page_stem(self, chapter, page):
+        return 'ch{}-p{:02d}'.format(chapter.number, int(page.number))
 
-        def build_chapter(chap, arch):
-            print("{} - {}: {} ({} pages)".format(chap.volume, chap.number, chap.title, len(chap.pages)))
+    def stored(self, url):
+        """
+        Whether the cached image at `url` is stored uncompressed by the
+        compression policy, it is then streamed from the cache as it is
+        """
+        head = head_cached(url, 16)
+        return head is not None and self.compression.compress_type(head) == ZIP_STORED
 
-            sorted_pages = sorted(chap.pages, key=lambda p: p.number)
-            # pprint(sorted_pages)
-            for page in sorted_pages:
-                file_name = 'ch{}-p{:02d}.jpg'.format(chap.number, int(page.number))
-                if page.image_url is None:
-                    page.image_url = self.adapter.get_image(page)
-                content = fetch_cached(page.image_url)
-                arch.writestr(file_name, content)
+    def page_key(self, chapter, page):
+        return stem_key(self.page_stem(chapter, page))
 
+    def page_extension(self):
+        """
+        :return: extension of the pages written, None when it follows the format of each image
+        """
+        return '.jpg' if self.transform is None else self.transform.extension()
+
+    def page_name(self, chapter, page, extension):
+        """
+        :param extension: Extension of the content written
+        """
+        return self.page_stem(chapter, page) + extension
+
+    def entry_matches(self, info, chapter, page):
+        """
+        Whether the entry `info` is up to date for `page`. Images the
+        transform fails on are kept in their own format, under their own
+        extension.
+        """
+        if entry_source(info) not in (None, page.image_url):
+            return False
+        extension = self.page_extension()
+        if extension is None or os.path.splitext(info.filename)[1] == extension:
+            return True
+        return self.transform is not None and transform_failed(page.image_url, self.transform)
+
+    def sorted_pages(self, volume):
+        """
+        List the pages of a volume in archive order
+
+        :return: [(Chapter, Page)]
+        """
         sorted_chapters = sorted(volume.chapters, key=lambda chap: chap.number)
         # pprint(sorted_chapters)
-        archive = ZipFile(filename, 'w')
+        return [(chap, page)
+                for chap in sorted_chapters
+                for page in sorted(chap.pages, key=lambda p: p.number)]
+
+    def start_chapter(self, archive, chapter):
+        """
+        Called by `write_pages` before the first page of each chapter
+        """
+        print("{} - {}: {} ({} pages)".format(chapter.volume, chapter.number, chapter.title, len(chapter.pages)))
+
+    def write_pages(self, archive, pages, source=None, journal=None):
+        """
+        Write pages to an archive in order. Each entry records the url of
+        its image in its comment, which is what `update_volume` compares.
+
+        :param archive: ZipFile to write to
+        :param pages: [(Chapter, Page)]
+        :param source: ZipFile whose up to date entries are copied instead of downloaded
+        :param journal: Journal recording each entry once written
+        """
+        source_entries = dict()
+        if source is not None:
+            source_entries = dict((entry_key(info.filename), info) for info in source.infolist())
+
+        def reusable(chap, page):
+            info = source_entries.get(self.page_key(chap, page))
+            if info is None or not self.entry_matches(info, chap, page):
+                return None
+            return info
+
+        compress = self.compression is not None and self.compression.method != 'store'
+        encode = compress or self.transform is not None
+
+        def fetch_item(item):
+            """
+            :return: (Chapter, Page, whether the entry is copied from `source`)
+            """
+            chap, page = item
+            if reusable(chap, page) is not None:
+                return chap, page, True
+            # downloaded here, the encoding pool and the writer only read the cache
+            self.fetch_page(page)
+            return chap, page, False
+
+        def encode_item(fetched):
+            """
+            :return: (Chapter, Page, entry name, content), the name is None for
+                     an entry copied from `source`, content is None to stream
+                     the image from the cache, bytes or an EntryCompressor
+            """
+            chap, page, reused = fetched
+            if reused:
+                return chap, page, None, None
+            if self.transform is not None:
+                # named from the actual output, the source format is kept without a format or when the transform fails
+                data, _ = transform_cached(page.image_url, self.transform)
+                name = self.page_name(chap, page, image_extension(data))
+                if not compress:
+                    return chap, page, name, data
+            else:
+                name = self.page_name(chap, page, self.page_extension())
+                if not compress or self.stored(page.image_url):
+                    return chap, page, name, None
+            # compressed in the worker threads, the writer only copies the result
+            compressor = EntryCompressor(self.compression)
+            if self.transform is not None:
+                compressor.write(data)
+            else:
+                stream_cached(page.image_url, compressor)
+            return chap, page, name, compressor
+
+        # downloads are as concurrent as page_parallel allows, transforms and
+        # compression run on a pool of their own sized for the CPUs
+        fetched = ordered_map(fetch_item, pages, self.page_parallel)
+        items = ordered_map(encode_item, fetched, os.cpu_count() if encode else None)
+
+        current = None
+        # pages are written by this thread only, in order
+        for chap, page, file_name, content in items:
+            if chap is not current:
+                self.start_chapter(archive, chap)
+                current = chap
+
+            with metrics.timer('zip.write'):
+                if file_name is None:
+                    info = copy_entry(source, reusable(chap, page), archive)
+                else:
+                    info = ZipInfo(file_name, date_time=time.localtime()[:6])
+                    info.comment = page.image_url.encode('utf-8')
+                    if isinstance(content, EntryCompressor):
+                        write_raw_entry(archive, info, content.finish(info))
+                    else:
+                        with archive.open(info, mode='w') as entry:
+                            if content is not None:
+                                entry.write(content)
+                            else:
+                                stream_cached(page.image_url, entry)
+            metrics.count('zip.entries')
+            metrics.count('zip.bytes', info.compress_size)
+
+            if journal is not None:
+                journal.record(archive, info)
+
+    def resume_partial(self, partial, journal, pages):
+        """
+        Reopen the partial archive left by an interrupted build
+
+        :return: ZipFile or None if there is nothing to resume
+        """
+        records = journal.read()
+        if len(records) == 0 or not os.path.exists(partial):
+            return None
+
+        expected = dict((self.page_key(chap, page), page.image_url) for chap, page in pages)
+        if any(expected.get(entry_key(record['name'])) != record['comment'] for record in records):
+            print("Discarding {}, the volume changed since".format(partial))
+            return None
+
         try:
-            for chapter in sorted_chapters:
-                build_chapter(chapter, archive)
+            return resume_archive(partial, records)
+        except (OSError, BadZipFile) as e:
+            print("Discarding {}: {}".format(partial, e))
+            return None
 
-            archive.close()
+    def build_volume(self, filename, volume, metadata):
+        """
+        Pages are written to a .partial archive and recorded in a .journal
+        file next to it. A build that fails resumes from the last recorded
+        page the next time, the archive is renamed once complete.
+        """
+        partial = "{}.partial".format(filename)
+        journal = Journal("{}.journal".format(filename))
+        pages = self.sorted_pages(volume)
+
+        archive = self.resume_partial(partial, journal, pages)
+        if archive is None:
+            archive = ZipFile(partial, 'w')
+            journal.open()
+        else:
+            print("Resuming {} from page {}/{}".format(filename, len(archive.filelist) + 1, len(pages)))
+            journal.open(journal.read())
+
+        written = set(entry_key(name) for name in archive.NameToInfo)
+        try:
+            self.write_pages(archive, [(chap, page) for chap, page in pages
+                                       if self.page_key(chap, page) not in written], journal=journal)
         except FetchError as e:
             print("Error in volume {}: {}".format(volume.number, e))
+            print("Progress kept in {}".format(partial))
+            return
+        finally:
             archive.close()
-            os.remove(filename)
-        else:
+            journal.close()
+
+        os.replace(partial, filename)
+        journal.remove()
+
+    def update_volume(self, filename, volume, metadata):
+        pages = self.sorted_pages(volume)
+        expected = dict((self.page_key(chap, page), (chap, page)) for chap, page in pages)
+
+        # entries renamed by `masc fix` are matched as well, they keep their names
+        with ZipFile(filename, 'r') as source:
+            entries = dict((entry_key(info.filename), info) for info in source.infolist())
+
+        missing = [(chap, page) for chap, page in pages if self.page_key(chap, page) not in entries]
+        stale = [info.filename for key, info in entries.items()
+                 if key not in expected or not self.entry_matches(info, *expected[key])]
+
+        if len(missing) == 0 and len(stale) == 0:
+            return False
+
+        tmp_name = "{}.tmp".format(filename)
+        if len(stale) == 0:
+            # appended to a copy, a page failing half written would stay in the archive as an empty entry
+            print("Appending {} pages to {}".format(len(missing), filename))
+            shutil.copyfile(filename, tmp_name)
+            archive = ZipFile(tmp_name, 'a')
+            try:
+                self.write_pages(archive, missing)
+                archive.close()
+            except BaseException:
+                archive.close()
+                os.remove(tmp_name)
+                raise
+            os.replace(tmp_name, filename)
+            return True
+
+        print("Rebuilding {} ({} stale, {} missing pages)".format(filename, len(stale), len(missing)))
+        with ZipFile(filename, 'r') as source:
+            archive = ZipFile(tmp_name, 'w')
+            try:
+                self.write_pages(archive, pages, source)
+                archive.close()
+            except BaseException:
+                archive.close()
+                os.remove(tmp_name)
+                raise
+
+        os.replace(tmp_name, filename)
+        return True
+
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{title}</title></head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+NAV_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>{title}</title></head>
+<body>
+  <nav epub:type="toc" id="toc">
+    <h1>Chapters</h1>
+    <ol>
+      {toc}
+    </ol>
+  </nav>
+</body>
+</html>
+"""
+
+PACKAGE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    {manifest}
+  </manifest>
+  <spine>
+    {spine}
+  </spine>
+</package>
+"""
+
+MEDIA_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
+
+
+class EbookAdapter(ArchiveAdapter):
+    """
+    EPUB 3 volumes, one XHTML document per chapter
+
+    The container is written as pages arrive, through the same pipeline as
+    the CBZ archives: the mimetype first, then the images, and the chapter
+    documents, package document and navigation once all the pages are in,
+    from the names the images were actually written under. Only the names
+    of the entries are kept in memory.
+    """
+
+    def file_format(self):
+        return '.epub'
+
+    def page_stem(self, chapter, page):
+        return 'OEBPS/images/' + super().page_stem(chapter, page)
+
+    def chapter_name(self, chapter):
+        return 'OEBPS/chap-{}.xhtml'.format(chapter.number)
+
+    def write_text(self, archive, name, text):
+        archive.writestr(ZipInfo(name, date_time=time.localtime()[:6]), text.encode('utf-8'),
+                         compress_type=ZIP_DEFLATED)
+
+    def write_chapters(self, archive, chapters):
+        """
+        Write the document of each chapter, after its images
+        """
+        names = dict((entry_key(info.filename), info.filename) for info in archive.infolist())
+        for chapter in chapters:
+            images = str.join("\n", ['<div><img src={} alt=""/></div>'.format(
+                quoteattr(names[self.page_key(chapter, page)][len('OEBPS/'):]))
+                for page in sorted(chapter.pages, key=lambda p: p.number)])
+            self.write_text(archive, self.chapter_name(chapter), XHTML.format(title=escape(str(chapter.title)),
+                                                                               body=images))
+
+    def write_cover(self, archive, metadata):
+        """
+        :return: name of the cover entry, None if there is none
+        """
+        if metadata.cover_url is None or metadata.cover_url == 'None':
+            return None
+        try:
+            # downloaded before the entry is opened, a failure leaves nothing behind
+            data = fetch_cached(metadata.cover_url)
+        except (FetchError, requests.RequestException) as e:
+            print("No cover: {}".format(e))
+            return None
+        name = 'OEBPS/images/cover' + image_extension(data)
+        archive.writestr(ZipInfo(name, date_time=time.localtime()[:6]), data)
+        return name
+
+    def write_package(self, archive, volume, metadata, chapters, cover):
+        identifier = "{}-v{:0>2s}".format(metadata.slug, str(volume.number))
+        title = "Volume {} - {}".format(volume.number, metadata.title)
+
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+        spine = list()
+        toc = list()
+        for index, chapter in enumerate(chapters):
+            href = self.chapter_name(chapter)[len('OEBPS/'):]
+            manifest.append('<item id="chap{}" href={} media-type="application/xhtml+xml"/>'.format(index, quoteattr(href)))
+            spine.append('<itemref idref="chap{}"/>'.format(index))
+            toc.append('<li><a href={}>{}</a></li>'.format(quoteattr(href), escape(str(chapter.title))))
+
+        prefix = 'OEBPS/images/'
+        for index, info in enumerate(info for info in archive.infolist() if info.filename.startswith(prefix)):
+            _, ext = os.path.splitext(info.filename)
+            properties = ' properties="cover-image"' if info.filename == cover else ''
+            manifest.append('<item id="img{}" href={} media-type="{}"{}/>'.format(
+                index, quoteattr(info.filename[len('OEBPS/'):]), MEDIA_TYPES.get(ext, 'image/jpeg'), properties))
+
+        self.write_text(archive, 'OEBPS/content.opf', PACKAGE_XML.format(
+            identifier=escape(identifier), title=escape(title), modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            manifest=str.join("\n    ", manifest), spine=str.join("\n    ", spine)))
+        self.write_text(archive, 'OEBPS/nav.xhtml', NAV_XHTML.format(title=escape(title), toc=str.join("\n      ", toc)))
+
+    def build_volume(self, filename, volume, metadata):
+        tmp_name = "{}.tmp".format(filename)
+        pages = self.sorted_pages(volume)
+        chapters = list()
+        for chap, page in pages:
+            if len(chapters) == 0 or chapters[-1] is not chap:
+                chapters.append(chap)
+
+        archive = ZipFile(tmp_name, 'w')
+        try:
+            # the mimetype must come first and be stored
+            archive.writestr(ZipInfo('mimetype', date_time=time.localtime()[:6]), b'application/epub+zip',
+                             compress_type=ZIP_STORED)
+            self.write_text(archive, 'META-INF/container.xml', CONTAINER_XML)
+            cover = self.write_cover(archive, metadata)
+            self.write_pages(archive, pages)
+            self.write_chapters(archive, chapters)
+            self.write_package(archive, volume, metadata, chapters, cover)
+        except BaseException as e:
             archive.close()
+            os.remove(tmp_name)
+            if not isinstance(e, FetchError):
+                raise
+            print("Error in volume {}: {}".format(volume.number, e))
+            return
+
+        archive.close()
+        os.replace(tmp_name, filename)
+
+    def update_volume(self, filename, volume, metadata):
+        # the package document lists every page, volumes are rebuilt instead
+        return False
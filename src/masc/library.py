@@ -0,0 +1,142 @@
+import json
+import time
+import traceback
+from argparse import Namespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+
+# settings a series of the manifest can override, with their defaults
+SERIES_DEFAULTS = {
+    'adapter': 'auto',
+    'format': 'cbz',
+    'out': None,
+    'volumes': [],
+    'incremental': True,
+    'rebuild': False,
+    'descriptor_format': 'xml',
+    'crawl_parallel': None,
+    # caps the crawl threads of the series only, the scheduler and its hosts stay shared
+    'crawl_host_limit': None,
+    'page_parallel': None,
+}
+
+
+def load_manifest(path, defaults=None):
+    """
+    Read a library manifest
+
+    {
+        "defaults": {"out": "library", "format": "cbz"},
+        "series": [
+            {"url": "http://mangafox.me/manga/some_series/", "out": "library/some_series"},
+            ...
+        ]
+    }
+
+    Each series needs a url, the other settings (see SERIES_DEFAULTS) come
+    from "defaults" when the series doesn't set them, then from `defaults`.
+
+    :param defaults: dict of settings given on the command line
+    :return: [dict] settings of each series
+    """
+    with open(path, mode='r', encoding='utf-8') as fp:
+        manifest = json.load(fp)
+
+    defaults = dict(SERIES_DEFAULTS, **(defaults or {}))
+    defaults.update(manifest.get('defaults', {}))
+
+    series = list()
+    for index, entry in enumerate(manifest.get('series', [])):
+        if 'url' not in entry:
+            raise RuntimeError("{}: series {} has no url".format(path, index))
+        unknown = set(entry.keys()) - set(SERIES_DEFAULTS.keys()) - {'url'}
+        if len(unknown) > 0:
+            raise RuntimeError("{}: series {} has unknown settings {}".format(path, index, str.join(', ', sorted(unknown))))
+        settings = dict(defaults)
+        settings.update(entry)
+        series.append(settings)
+    return series
+
+
+def interleave_sites(series):
+    """
+    Order series round-robin across their sites, so that the workers are
+    shared between sites instead of going through one site after another
+    """
+    sites = OrderedDict()
+    for settings in series:
+        sites.setdefault(urlsplit(settings['url']).netloc, list()).append(settings)
+
+    queues = list(sites.values())
+    ordered = list()
+    while len(queues) > 0:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if len(queue) > 0]
+    return ordered
+
+
+def sync_series(settings, args, make_engine):
+    """
+    Crawl and build one series of the library
+
+    :param settings: Series settings from the manifest
+    :param args: Command line arguments, for what the manifest doesn't set
+    :param make_engine: function(settings) -> ScraperEngine
+    :return: summary dict
+    """
+    start = time.time()
+    summary = {'url': settings['url'], 'title': None, 'status': 'ok', 'volumes': {}, 'seconds': 0.0, 'error': None}
+
+    series_args = Namespace(**vars(args))
+    for key, value in settings.items():
+        setattr(series_args, key, value)
+    # volumes are built on threads of this process, the workers are shared by the series
+    series_args.parallel = None
+
+    try:
+        engine = make_engine(settings)
+        results = engine.run(series_args)
+        summary['title'] = engine.descriptor.metadata.title
+        for number, filename, status, seconds in results:
+            summary['volumes'][status] = summary['volumes'].get(status, 0) + 1
+        if summary['volumes'].get('failed', 0) > 0:
+            summary['status'] = 'partial'
+    except Exception as e:
+        traceback.print_exc()
+        summary['status'] = 'failed'
+        summary['error'] = str(e)
+
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def sync_library(series, args, make_engine, workers):
+    """
+    Sync all the series of a library, `workers` series at a time
+
+    :return: [summary dict] in manifest order
+    """
+    ordered = interleave_sites(series)
+    summaries = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(sync_series, settings, args, make_engine), index)
+                       for index, settings in enumerate(ordered))
+        for done, future in enumerate(as_completed(futures), start=1):
+            summary = future.result()
+            summaries[id(ordered[futures[future]])] = summary
+            print("[{}/{}] {} {} in {:.1f}s".format(done, len(ordered), summary['url'], summary['status'],
+                                                    summary['seconds']))
+
+    return [summaries[id(settings)] for settings in series]
+
+
+def print_summary(summaries):
+    statuses = ('written', 'updated', 'exists', 'failed')
+    print("{:<8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format('status', *statuses + ('seconds', 'series')))
+    for summary in summaries:
+        counts = [summary['volumes'].get(status, 0) for status in statuses]
+        print("{:<8} {:>8} {:>8} {:>8} {:>8} {:>8.1f}  {}".format(summary['status'], *counts + [summary['seconds'],
+                                                                summary['title'] or summary['url']]))
@@ -2,9 +2,16 @@ import fnmatch
 import importlib
 import os
 import re
+import time
+from multiprocessing import Pool
 from zipfile import ZipFile, BadZipfile
 
 from masc.scraper import ScraperEngine
+from masc.archive import copy_entry
+from masc.client import client, configure
+from masc.scheduler import scheduler, configure as configure_scheduler
+from masc.cache import image_cache, page_cache, parse_size, format_size
+from masc.metrics import metrics, Progress
 
 
 def get_class(dotted_name, default_package):
@@ -19,6 +26,58 @@ def get_class(dotted_name, default_package):
     return getattr(package_inst, class_name)
 
 
+def configure_client(args):
+    configure(pool_size=args.pool_size, timeout=args.timeout)
+    configure_scheduler(rate=args.rate_limit, burst=args.burst, concurrency=args.host_limit, retries=args.retries)
+
+
+def configure_cache(args):
+    image_cache.configure(root=args.cache_dir, max_size=parse_size(args.cache_size), policy=args.cache_policy)
+    ttls = dict((kind, getattr(args, kind + '_ttl', None)) for kind in ('meta', 'chapters', 'pages'))
+    page_cache.configure(ttls=ttls, enabled=not getattr(args, 'no_page_cache', False))
+
+
+def make_transform(args):
+    """
+    Image transform asked for on the command line, None if there is none
+    """
+    from masc.transform import Transform, Image
+    if args.resize_height is None and args.quality is None and args.image_format is None:
+        return None
+    if Image is None:
+        print("Image transforms require package Pillow")
+        exit(-1)
+    return Transform(max_height=args.resize_height, quality=args.quality, format=args.image_format,
+                     strip=not args.keep_metadata)
+
+
+def start_progress(args):
+    if not args.progress:
+        return None
+    progress = Progress()
+    progress.start()
+    return progress
+
+
+def finish_run(args, progress):
+    if progress is not None:
+        progress.stop()
+    print_client_stats()
+    if args.metrics is not None:
+        metrics.save(args.metrics)
+        print("Metrics written to", args.metrics)
+
+
+def print_client_stats():
+    stats = client.stats()
+    if stats['requests'] > 0:
+        print("HTTP: {requests} requests over {connections} connections ({reused} reused)".format(**stats))
+
+    stats = scheduler.stats()
+    if stats['retries'] > 0:
+        print("HTTP: {retries} retries, {throttled} throttled, {paused:.1f}s paused".format(**stats))
+
+
 def crawl(args):
     adapter_cls_inst = None
     try:
@@ -27,10 +86,14 @@ def crawl(args):
         print("Adapter not found")
         exit(-1)
 
+    configure_client(args)
+    progress = start_progress(args)
+    configure_cache(args)
     adapter = adapter_cls_inst(args.url)
 
     scraper = ScraperEngine(adapter, None)
     scraper.crawl(args)
+    finish_run(args, progress)
 
 
 def build(args):
@@ -41,10 +104,17 @@ def build(args):
         print("Adapter not found")
         exit(-1)
 
+    configure_client(args)
+    progress = start_progress(args)
+    configure_cache(args)
     output = format_cls_inst(None)
+    output.page_parallel = args.page_parallel
+    output.compression = args.compression
+    output.transform = make_transform(args)
 
     scraper = ScraperEngine(None, output)
     scraper.build(args)
+    finish_run(args, progress)
 
 
 def download(args):
@@ -57,58 +127,169 @@ def download(args):
         print("Adapter not found")
         exit(-1)
 
+    configure_client(args)
+    progress = start_progress(args)
+    configure_cache(args)
     adapter = adapter_cls_inst(args.url)
     output = format_cls_inst(adapter)
+    output.page_parallel = args.page_parallel
+    output.compression = args.compression
+    output.transform = make_transform(args)
 
     scraper = ScraperEngine(adapter, output)
     scraper.run(args)
+    finish_run(args, progress)
+
+
+def sync(args):
+    from masc.library import load_manifest, sync_library, print_summary
+    import json
+
+    try:
+        defaults = dict((key, getattr(args, key)) for key in ('format', 'out', 'page_parallel')
+                        if getattr(args, key) is not None)
+        series = load_manifest(args.manifest, defaults)
+    except (OSError, ValueError, RuntimeError) as e:
+        print("Failed to read manifest!", e)
+        exit(-1)
+
+    configure_client(args)
+    progress = start_progress(args)
+    configure_cache(args)
+    transform = make_transform(args)
+
+    def make_engine(settings):
+        adapter = get_class(settings['adapter'], 'masc.adapter')(settings['url'])
+        output = get_class(settings['format'], 'masc.format')(adapter)
+        output.page_parallel = settings['page_parallel']
+        output.compression = args.compression
+        output.transform = transform
+        return ScraperEngine(adapter, output)
+
+    summaries = sync_library(series, args, make_engine, args.workers)
+    print_summary(summaries)
+    finish_run(args, progress)
+
+    if args.summary is not None:
+        with open(args.summary, mode='w', encoding='utf-8') as fp:
+            json.dump(summaries, fp, indent=2)
+
+
+FIX_PATTERN = re.compile(r"^ch(?P<chap>[^\-]+)-p(?P<page>\d+).jpg$")
+
+
+def fix_name(name):
+    """
+    Normalized name of a page entry
+
+    :return: new name, or None if `name` needs no change
+    """
+    match = FIX_PATTERN.match(name)
+    if match is None:
+        return None
+    chap, page = match.group('chap', 'page')
+    new_name = "ch{:03.1f}-p{:03d}.jpg".format(float(chap), int(page)).replace(".0", "")
+    if new_name == name:
+        return None
+    return new_name
+
+
+def fix_file(name):
+    """
+    Rename the page entries of an archive, entries are copied as they are
+    without being decompressed. Archives that need no renames are left
+    untouched.
+
+    :return: (name, status, renamed entries), status is fixed, clean or error
+    """
+    tmp_name = "{}.tmp".format(name)
+    try:
+        with ZipFile(name, mode='r') as old_file:
+            renames = dict((info.filename, fix_name(info.filename)) for info in old_file.infolist())
+            renamed = sum(1 for new_name in renames.values() if new_name is not None)
+            if renamed == 0:
+                return name, 'clean', 0
+
+            with ZipFile(tmp_name, mode='w') as new_file:
+                for info in old_file.infolist():
+                    copy_entry(old_file, info, new_file, renames[info.filename])
+        os.replace(tmp_name, name)
+        return name, 'fixed', renamed
+    except (BadZipfile, OSError, ValueError) as e:
+        print("Error with file {}: {}".format(name, e))
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        return name, 'error', 0
 
 
 def fix_path(args):
-    def fix_file(name):
-        print("Fixing {}".format(name))
-        pattern = re.compile(r"^ch(?P<chap>[^\-]+)-p(?P<page>\d+).jpg$")
-
-        tmp_name = "{}.old".format(name)
-        os.rename(name, tmp_name)
-        old_file = ZipFile(tmp_name, mode='r')
-        new_file = ZipFile(name, mode='w')
-
-        for file in old_file.filelist:
-            match = pattern.match(file.filename)
-            if match is None:
-                # print("Object {} does not match pattern".format(file.filename))
-                new_file.writestr(file.filename, old_file.read(file.filename))
-            else:
-                chap, page = match.group('chap', 'page')
-                new_name = "ch{:03.1f}-p{:03d}.jpg".format(float(chap), int(page)).replace(".0", "")
-                # print("Renaming {} to {}".format(file.filename, new_name))
-                new_file.writestr(new_name, old_file.read(file.filename))
-
-        old_file.close()
-        new_file.close()
-        os.remove(tmp_name)
-
-    for dirpath, dirnames, filenames in os.walk(args.path):
-        for filename in fnmatch.filter(filenames, '*.cbz'):
-            path = os.path.join(dirpath, filename)
-            try:
-                fix_file(path)
-            except BadZipfile:
-                print("Error with file {}".format(path))
+    def archives():
+        for dirpath, dirnames, filenames in os.walk(args.path):
+            for filename in fnmatch.filter(filenames, '*.cbz'):
+                yield os.path.join(dirpath, filename)
+
+    start = time.time()
+    counts = {'fixed': 0, 'clean': 0, 'error': 0}
+    renamed = 0
+    with Pool(processes=args.parallel) as pool:
+        for name, status, count in pool.imap_unordered(fix_file, archives(), chunksize=8):
+            if status == 'fixed':
+                print("Fixed {} ({} entries renamed)".format(name, count))
+            counts[status] += 1
+            renamed += count
+
+    print("{} archives in {:.1f}s: {} fixed ({} entries renamed), {} already fine, {} errors".format(
+        sum(counts.values()), time.time() - start, counts['fixed'], renamed, counts['clean'], counts['error']))
+
+
+def cache(args):
+    configure_cache(args)
+
+    if args.action == 'stats':
+        stats = image_cache.stats()
+        print("Files:", stats['files'])
+        print("URLs:", stats['urls'])
+        print("Size:", format_size(stats['size']))
+        if stats['max_size'] is not None:
+            print("Budget: {} ({})".format(format_size(stats['max_size']), stats['policy']))
+        pages = page_cache.stats()
+        print("HTML pages: {} ({})".format(pages['pages'], format_size(pages['size'])))
+        legacy = sum(1 for _ in image_cache.iter_legacy())
+        if legacy > 0:
+            print("Legacy files: {} (run 'cache migrate')".format(legacy))
+    elif args.action == 'prune':
+        if image_cache.max_size is None:
+            print("Pruning requires --cache-size")
+            exit(-1)
+        count, size = image_cache.evict(image_cache.max_size)
+        print("Removed {} files and pages ({})".format(count, format_size(size)))
+    elif args.action == 'verify':
+        report = image_cache.verify(repair=args.repair, deep=args.deep)
+        print("Checked {checked} files: {missing} missing, {corrupt} corrupt, {orphans} orphans".format(**report))
+        if args.repair:
+            print("Repaired")
+    elif args.action == 'migrate':
+        print("Imported {} files".format(image_cache.migrate()))
+
+
+def convert(args):
+    from masc.descriptor import Descriptor
+    descriptor = Descriptor.load(args.source)
+    descriptor.save(args.target)
+    print("Converted {} to {}".format(args.source, args.target))
 
 
 def show(args):
     from masc.descriptor import Descriptor
     try:
-        descriptor = Descriptor.load(args.descriptor)
+        descriptor = Descriptor.open(args.descriptor)
 
         print("Title:", descriptor.metadata.title)
         print("Slug:", descriptor.metadata.slug)
-        for number, volume in sorted(descriptor.volumes.items(), key=lambda p: p[0]):
+        for number in sorted(descriptor.volumes.keys()):
             print("Volume", number)
-            for chapter in sorted(volume.chapters, key=lambda c: c.number):
-                print("- Chapter %s: %s (%d pages)" % (chapter.number, chapter.title, len(chapter.pages)))
+            for chapter_number, title, page_count in sorted(descriptor.summary(number), key=lambda c: c[0]):
+                print("- Chapter %s: %s (%d pages)" % (chapter_number, title, page_count))
 
     except Exception as ex:
         print("Failed to process descriptor!", ex.args)
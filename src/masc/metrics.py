@@ -0,0 +1,158 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Metrics(object):
+    """
+    Counters, timers and latency histograms of the current process
+
+    Build workers send a snapshot of their metrics back with each volume
+    and the parent merges it into its own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = dict()
+            self.timers = dict()
+
+    def reset_after_fork(self):
+        """
+        Start over in a worker process, which may have copied the lock held
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Record a duration of the stage `name`
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer['buckets'][index] += 1
+                    break
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': dict((name, dict(timer, buckets=list(timer['buckets'])))
+                               for name, timer in self.timers.items()),
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot['timers'].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.timers[name] = dict(other, buckets=list(other['buckets']))
+                    continue
+                timer['count'] += other['count']
+                timer['total'] += other['total']
+                timer['max'] = max(timer['max'], other['max'])
+                timer['buckets'] = [a + b for a, b in zip(timer['buckets'], other['buckets'])]
+
+    def report(self):
+        """
+        Metrics of the run so far, as exported to the metrics file
+        """
+        snapshot = self.snapshot()
+        elapsed = time.time() - self.started
+        counters = snapshot['counters']
+        timers = dict()
+        for name, timer in snapshot['timers'].items():
+            timers[name] = {
+                'count': timer['count'],
+                'total': timer['total'],
+                'mean': timer['total'] / timer['count'] if timer['count'] > 0 else 0.0,
+                'max': timer['max'],
+                'histogram': dict(('le_{}'.format(bound), count) for bound, count in zip(BUCKETS, timer['buckets'])),
+            }
+        return {
+            'elapsed': elapsed,
+            'counters': counters,
+            'rates': {
+                'download_bytes_per_sec': counters.get('fetch.bytes', 0) / elapsed if elapsed > 0 else 0.0,
+                'written_bytes_per_sec': counters.get('zip.bytes', 0) / elapsed if elapsed > 0 else 0.0,
+                'pages_per_sec': counters.get('zip.entries', 0) / elapsed if elapsed > 0 else 0.0,
+            },
+            'timers': timers,
+        }
+
+    def save(self, path):
+        with open(path, mode='w', encoding='utf-8') as fp:
+            json.dump(self.report(), fp, indent=2, sort_keys=True)
+
+    def status_line(self):
+        with self.lock:
+            counters = dict(self.counters)
+            elapsed = time.time() - self.started
+        downloaded = counters.get('fetch.bytes', 0)
+        return "{:.0f}s | {} pages | {} requests | cache {} hits / {} misses | {:.1f} MB at {:.2f} MB/s".format(
+            elapsed, counters.get('zip.entries', 0), counters.get('http.requests', 0),
+            counters.get('cache.hit', 0), counters.get('cache.miss', 0),
+            downloaded / 1e6, downloaded / 1e6 / elapsed if elapsed > 0 else 0.0)
+
+
+metrics = Metrics()
+
+
+class Progress(object):
+    """
+    Status line refreshed on stderr while a command runs
+    """
+
+    def __init__(self, interval=1.0, out=sys.stderr):
+        self.interval = interval
+        self.out = out
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.out.write("\r\x1b[K" + metrics.status_line())
+            self.out.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='progress', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.out.write("\r\x1b[K" + metrics.status_line() + "\n")
+        self.out.flush()
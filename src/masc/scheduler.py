@@ -0,0 +1,294 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from masc.client import client
+from masc.metrics import metrics
+
+
+# responses worth retrying after a pause
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# errors worth retrying, while sending a request or reading its body
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def retry_after(resp):
+    """
+    Delay requested by a Retry-After header, in seconds
+
+    :return: float or None if the header is missing or invalid
+    """
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostState(object):
+    """
+    Pacing of the requests sent to one host
+
+    Requests take a token from a bucket refilled at `rate` per second and
+    a slot out of `limit` concurrent ones. The limit grows by one for every
+    `limit` successful requests and is halved on a throttled or failed one
+    (AIMD), and failures pause the whole host for an exponential backoff.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.cond = threading.Condition()
+        self.tokens = float(scheduler.burst or 1)
+        self.updated = time.monotonic()
+        self.limit = scheduler.concurrency
+        self.in_flight = 0
+        self.failures = 0
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        rate = self.scheduler.rate
+        if rate is None:
+            return
+        burst = float(self.scheduler.burst or 1)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Time to wait before a request can start, 0 if it can start now
+        """
+        if self.paused_until > now:
+            return self.paused_until - now
+        limit = self.limit
+        cap = getattr(self.scheduler.local, 'cap', None)
+        if cap is not None:
+            limit = cap if limit is None else min(limit, cap)
+        if limit is not None and self.in_flight >= int(limit):
+            # woken up by release
+            return None
+        if self.scheduler.rate is not None and self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.scheduler.rate
+        return 0
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                delay = self.wait_time(now)
+                if delay == 0:
+                    break
+                self.cond.wait(delay)
+
+            if self.scheduler.rate is not None:
+                self.tokens -= 1.0
+            self.in_flight += 1
+
+    def release(self, ok, delay=None):
+        """
+        End a request
+
+        :param ok: False if the request was throttled or failed
+        :param delay: Pause requested by the server, in seconds
+        :return: Pause applied to the host, in seconds
+        """
+        scheduler = self.scheduler
+        pause = 0.0
+        with self.cond:
+            self.in_flight -= 1
+            if ok:
+                self.failures = 0
+                if self.limit is not None:
+                    self.limit = min(self.limit + 1.0 / self.limit, scheduler.max_concurrency or float('inf'))
+            else:
+                self.failures += 1
+                # an unbounded host gets a limit the first time it fails
+                limit = self.limit if self.limit is not None else self.in_flight + 1
+                self.limit = max(1.0, limit / 2.0)
+                if delay is None:
+                    delay = scheduler.backoff * (2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+                pause = min(delay, scheduler.max_backoff)
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.cond.notify_all()
+        return pause
+
+
+class Scheduler(object):
+    """
+    Paces all the requests of the process, host by host
+
+    Limits apply per process, build workers are given their share of the
+    rate by the engine.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, retries=3, backoff=0.5, max_backoff=60.0):
+        """
+        :param rate: Requests per second per host (None for unbounded)
+        :param burst: Requests that can be sent at once after an idle period
+        :param concurrency: Maximum concurrent requests per host (None for unbounded)
+        :param retries: Retries on throttled (429), 5xx and failed requests
+        :param backoff: Base of the exponential backoff, in seconds
+        :param max_backoff: Longest pause, in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hosts = dict()
+        self.counters = {'requests': 0, 'retries': 0, 'throttled': 0, 'paused': 0.0}
+
+    def configure(self, rate=None, burst=None, concurrency=None, retries=None):
+        """
+        Change the settings, unset values are left as is. Resets the hosts.
+        """
+        with self.lock:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+            if concurrency is not None:
+                self.concurrency = self.max_concurrency = concurrency
+            if retries is not None:
+                self.retries = retries
+            self.hosts.clear()
+
+    def settings(self):
+        return self.rate, self.burst, self.concurrency, self.retries
+
+    @contextmanager
+    def capped(self, concurrency):
+        """
+        Requests sent by the current thread within the block wait until
+        fewer than `concurrency` requests are in flight on their host. The
+        settings and the state of the hosts are left as they are.
+
+        :param concurrency: Maximum concurrent requests per host (None for no cap)
+        """
+        previous = getattr(self.local, 'cap', None)
+        self.local.cap = concurrency
+        try:
+            yield
+        finally:
+            self.local.cap = previous
+
+    def host(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(self)
+            return self.hosts[host]
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def open(self, url, method='GET', **kwargs):
+        """
+        Send a request when the host allows it, retrying throttled and
+        failed ones. The host slot is held until the block exits, so that
+        streamed bodies count as in flight. Errors reading the body inside
+        the block are not retried here (see `retry`), they pause the host.
+
+        :return: context manager yielding the response, the last one if retries ran out
+        """
+        host = self.host(url)
+        attempt = 0
+        while True:
+            host.acquire()
+            self.count('requests')
+            metrics.count('http.requests')
+            try:
+                with metrics.timer('http.request'):
+                    resp = client.request(method, url, **kwargs)
+            except RETRY_ERRORS:
+                metrics.count('http.errors')
+                pause = host.release(False)
+                if attempt >= self.retries:
+                    raise
+                self.retry(pause)
+                attempt += 1
+                continue
+
+            if resp.status_code in RETRY_STATUSES and attempt < self.retries:
+                resp.close()
+                if resp.status_code == 429:
+                    self.count('throttled')
+                    metrics.count('http.throttled')
+                self.retry(host.release(False, retry_after(resp)))
+                attempt += 1
+                continue
+
+            ok = resp.status_code not in RETRY_STATUSES
+            try:
+                yield resp
+            except RETRY_ERRORS:
+                # the body failed to stream, the host backs off as for a failed request
+                metrics.count('http.errors')
+                ok = False
+                raise
+            finally:
+                resp.close()
+                host.release(ok)
+            return
+
+    def retry(self, pause):
+        self.count('retries')
+        metrics.count('http.retries')
+        self.count('paused', pause)
+        time.sleep(pause)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request and read its whole body
+
+        :return: requests.Response
+        """
+        with self.open(url, method, **kwargs) as resp:
+            resp.content
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def stats(self):
+        """
+        Request counters and the concurrency reached per host
+
+        :return: dict with requests, retries, throttled, paused and limits
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['limits'] = dict((host, state.limit) for host, state in self.hosts.items())
+        return stats
+
+
+scheduler = Scheduler()
+
+
+def configure(rate=None, burst=None, concurrency=None, retries=None):
+    """
+    Change the settings of the shared scheduler
+    (used as a Pool initializer for worker processes)
+    """
+    scheduler.configure(rate, burst, concurrency, retries)
@@ -1,9 +1,121 @@
+import time
+import requests
 from multiprocessing import Pool
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from masc.util import *
+from masc.client import configure as configure_client
+from masc.scheduler import scheduler, configure as configure_scheduler
+from masc.cache import image_cache
+from masc.metrics import metrics
 from masc.descriptor import *
 from pprint import pprint
 
 
+def init_worker(client_settings, cache_settings, scheduler_settings):
+    """
+    Apply the parent settings in a build worker process
+    """
+    configure_client(*client_settings)
+    image_cache.configure(*cache_settings)
+    configure_scheduler(*scheduler_settings)
+    metrics.reset_after_fork()
+
+
+def build_volume_file(format, metadata, dir, volume):
+    """
+    Build or update the file of a volume
+
+    :param format: FormatAdapter instance
+    :param metadata: Series metadata
+    :param dir: Output directory
+    :param volume: Volume to build
+    :return: (volume number, filename, status, seconds), status is one of
+             written, updated, exists or failed
+    """
+    start = time.time()
+    filename = None
+    try:
+        ebook_id = '%s-v%s' % (metadata.slug, volume.number)
+        filename = os.path.join(dir, ebook_id + format.file_format())
+        try:
+            os.makedirs(dir)
+        except FileExistsError:
+            pass
+
+        if os.path.exists(filename):
+            if format.update_volume(filename, volume, metadata):
+                status = 'updated'
+            else:
+                status = 'exists'
+        else:
+            with metrics.timer('build.volume'):
+                format.build_volume(filename, volume, metadata)
+            # formats leave no file behind when the build failed
+            status = 'written' if os.path.exists(filename) else 'failed'
+    except FetchError as e:
+        print("Error in volume {}: {}".format(volume.number, e))
+        status = 'failed'
+    except Exception:
+        import traceback
+        print("Exception in build_volume")
+        traceback.print_exc()
+        status = 'failed'
+
+    return volume.number, filename, status, time.time() - start
+
+
+def report_volume(result):
+    number, filename, status, elapsed = result
+    if status == 'written':
+        print("Written", filename)
+    elif status == 'updated':
+        print("Updated", filename)
+    elif status == 'exists':
+        print(filename, "already exists")
+    else:
+        print("Failed to build volume", number)
+
+
+# state of a build worker process, set once by init_builder
+builder = dict()
+
+
+def init_builder(client_settings, cache_settings, scheduler_settings, format, metadata, source, dir):
+    """
+    Set up a build worker process with what all its volumes share
+    """
+    init_worker(client_settings, cache_settings, scheduler_settings)
+    builder.update(format=format, metadata=metadata, source=source, dir=dir)
+
+
+def build_task(task):
+    """
+    Build a volume in a worker process
+
+    :param task: Volume, or the number of a volume to read from the shared descriptor source
+    :return: result of `build_volume_file`, metrics of the build
+    """
+    metrics.reset()
+    if isinstance(task, Volume):
+        volume = task
+    else:
+        volume = builder['source'].load_volume(task)
+    result = build_volume_file(builder['format'], builder['metadata'], builder['dir'], volume)
+    return result, metrics.snapshot()
+
+
+def volume_matches(number, volumes):
+    """
+    Whether the volume `number` is one of `volumes`, volumes without a
+    numeric key (such as "None") never match
+    """
+    try:
+        return int(number) in volumes
+    except (TypeError, ValueError):
+        return False
+
+
 class SiteAdapter(object):
     """
     Abstracts the website for the scraper
@@ -41,10 +153,22 @@ class SiteAdapter(object):
         """
         raise NotImplementedError
 
+    def get_images(self, chapter):
+        """
+        Get the image urls of all the pages of `chapter` in one go,
+        the engine falls back to `get_image` when this is not implemented
+        :param chapter: Chapter with its pages
+        :return: [image_url] in the order of chapter.pages, None for the pages left to `get_image`
+        """
+        raise NotImplementedError
+
 
 class FormatAdapter(object):
     def __init__(self, adapter):
         self.adapter = adapter
+        self.page_parallel = None
+        self.compression = None
+        self.transform = None
 
     def file_format(self):
         """
@@ -64,6 +188,20 @@ class FormatAdapter(object):
         """
         raise NotImplementedError
 
+    def update_volume(self, filename, volume, metadata):
+        """
+        Bring an existing volume file up to date with `volume`, only adding
+        what is missing. Formats that can't be updated leave the file as is.
+        (this method must be thread-safe)
+
+        :param filename: Existing filename
+        :param volume: Volume descriptor
+        :param metadata: Series metadata
+        :return: True if the file was changed
+        :raise FetchError: if a page could not be fetched, the file is left as it was
+        """
+        return False
+
 
 class ScraperEngine(object):
     """
@@ -80,56 +218,236 @@ class ScraperEngine(object):
         self.adapter = adapter
         self.format = format
         self.descriptor = None
+        self.dirty_volumes = set()
         self.dir = '.'
 
+    def descriptor_name(self, name, args):
+        return "{}.{}".format(name, getattr(args, 'descriptor_format', 'xml'))
+
     def build_volume(self, volume):
         """
         Build an ebook for a volume
 
         :param volume: Volume object to build from
-        :return: None
+        :return: see `build_volume_file`
+        """
+        result = build_volume_file(self.format, self.descriptor.metadata, self.dir, volume)
+        report_volume(result)
+        return result
+
+    def volume_weight(self, number):
+        """
+        Number of pages of a volume, read without loading it
+        """
+        return sum(page_count for _, _, page_count in self.descriptor.summary(number))
+
+    def build_parallel(self, numbers, processes):
+        """
+        Build volumes across a pool of processes
+
+        Each task is a single volume, or only its number when the workers can
+        read it from the descriptor file themselves. Volumes are handed out
+        one at a time, largest first, so that a long volume doesn't hold
+        back the end of the build, and results are reported as they finish.
+
+        :param numbers: Volume numbers to build
+        :param processes: Number of worker processes
+        :return: [result of `build_volume_file`] in completion order
+        """
+        volumes = self.descriptor.volumes
+        source = None
+        if isinstance(volumes, LazyVolumes):
+            source = volumes.source
+
+        tasks = list()
+        for number in sorted(numbers, key=self.volume_weight, reverse=True):
+            if source is not None and not volumes.is_loaded(number):
+                tasks.append(number)
+            else:
+                tasks.append(volumes[number])
+
+        # forward the client, cache and scheduler settings to the workers,
+        # each worker paces its own requests with a share of the rate
+        rate, burst, concurrency, retries = scheduler.settings()
+        if rate is not None:
+            rate = rate / processes
+        if concurrency is not None:
+            concurrency = max(concurrency // processes, 1)
+        settings = ((client.pool_size, client.timeout),
+                    (image_cache.root, image_cache.max_size, image_cache.policy),
+                    (rate, burst, concurrency, retries),
+                    self.format, self.descriptor.metadata, source, self.dir)
+        results = list()
+        with Pool(processes=processes, initializer=init_builder, initargs=settings) as pool:
+            for done, (result, snapshot) in enumerate(pool.imap_unordered(build_task, tasks, chunksize=1), start=1):
+                metrics.merge(snapshot)
+                print("[{}/{}] {:.1f}s".format(done, len(tasks), result[3]), end=' ')
+                report_volume(result)
+                results.append(result)
+        return results
+
+    def crawl_pages(self, chapter):
+        """
+        Fetch the list of pages of a chapter
+
+        :param chapter: Chapter to crawl
+        :return: Chapter
+        """
+        print("Chapter {}".format(chapter.number))
+        with metrics.timer('crawl.pages'):
+            for_each(self.adapter.get_pages(chapter), chapter.add_page)
+        metrics.count('crawl.chapters')
+        return chapter
+
+    def resolve_images(self, chapter):
+        """
+        Resolve the image urls of a chapter in bulk if the adapter supports it
+
+        :param chapter: Chapter with its pages
+        :return: [Page] left to resolve one by one
         """
         try:
-            ebook_id = '%s-v%s' % (self.descriptor.metadata.slug, volume.number)
-            filename = os.path.join(self.dir, ebook_id + self.format.file_format())
-            try:
-                os.makedirs(self.dir)
-            except FileExistsError:
-                pass
-
-            if os.path.exists(filename):
-                print(filename, "already exists")
-                return
-
-            self.format.build_volume(filename, volume, self.descriptor.metadata)
-
-            print("Written", filename)
-        except Exception as ex:
-            import traceback
-            print("Exception in build_volume")
-            traceback.print_exc()
-
-    def crawl(self, args):
-        self.descriptor = Descriptor()
-        self.descriptor.metadata = self.adapter.get_meta()
+            with metrics.timer('crawl.images'):
+                images = self.adapter.get_images(chapter)
+        except NotImplementedError:
+            return list(chapter.pages)
 
-        print("Crawling ...")
-        chapters = self.adapter.get_chapters()
-        for chapter in chapters:
-            print("Chapter {}".format(chapter.number))
-            pages = self.adapter.get_pages(chapter)
-            for page in pages:
-                page.image_url = self.adapter.get_image(page)
-                chapter.add_page(page)
-
-            if chapter.volume not in self.descriptor.volumes:
-                self.descriptor.volumes[chapter.volume] = Volume(chapter.volume)
-            self.descriptor.volumes[chapter.volume].add_chapter(chapter)
-
-        if args.out is None:
-            cache_name = "{}.xml".format(self.descriptor.metadata.slug)
+        for page, image_url in zip(chapter.pages, images):
+            page.image_url = image_url
+        return [page for page in chapter.pages if page.image_url is None]
+
+    def resolve_image(self, page):
+        """
+        Resolve the image url of a page
+
+        :param page: Page to resolve
+        :return: Page
+        """
+        with metrics.timer('crawl.image'):
+            page.image_url = self.adapter.get_image(page)
+        return page
+
+    def crawl_chapter(self, chapter):
+        """
+        Fetch the pages of a chapter and resolve their image urls
+
+        :return: Chapter
+        """
+        self.crawl_pages(chapter)
+        for_each(self.resolve_images(chapter), self.resolve_image)
+        return chapter
+
+    def prefetch_chapter(self, chapter):
+        """
+        Download the images of a chapter into the cache ahead of the writer,
+        images that fail are left for the writer to report
+
+        :return: Chapter
+        """
+        with metrics.timer('pipeline.fetch'):
+            for page in chapter.pages:
+                try:
+                    prefetch_cached(page.image_url)
+                except (FetchError, requests.RequestException) as e:
+                    print("Cannot fetch page {} of chapter {}: {}".format(page.number, chapter.number, e))
+        return chapter
+
+    def add_chapter(self, chapter):
+        # volumes are keyed by string, like in a loaded descriptor
+        chapter.volume = str(chapter.volume)
+        if chapter.volume not in self.descriptor.volumes:
+            self.descriptor.volumes[chapter.volume] = Volume(chapter.volume)
+        self.descriptor.volumes[chapter.volume].add_chapter(chapter)
+
+    def remove_chapter(self, chapter):
+        volume = self.descriptor.volumes[chapter.volume]
+        volume.chapters.remove(chapter)
+        if len(volume.chapters) == 0:
+            del self.descriptor.volumes[chapter.volume]
+
+    def crawl_chapters(self, chapters, args):
+        """
+        Fetch the pages and image urls of `chapters` and add them to the descriptor
+
+        :param chapters: [Chapter]
+        """
+        parallel = getattr(args, 'crawl_parallel', None)
+        if parallel is None:
+            for_each(chapters, self.crawl_chapter)
+        else:
+            host_limit = getattr(args, 'crawl_host_limit', None)
+
+            def capped(func):
+                def wrapper(item):
+                    with scheduler.capped(host_limit):
+                        return func(item)
+                return wrapper
+
+            # executor.map preserves input order, chapters and pages stay sorted
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                for_each(executor.map(capped(self.crawl_pages), chapters), lambda chapter: None)
+                pending = [page for pages in executor.map(capped(self.resolve_images), chapters) for page in pages]
+                for_each(executor.map(capped(self.resolve_image), pending), lambda page: None)
+
+        for_each(chapters, self.add_chapter)
+
+    def crawl_incremental(self, args):
+        """
+        Update the loaded descriptor with the chapters that are new or changed
+        on the site. Chapters no longer listed by the site are kept.
+
+        :return: set of dirty volume numbers
+        """
+        known = dict()
+        for volume in self.descriptor.volumes.values():
+            for chapter in volume.chapters:
+                known[str(chapter.number)] = chapter
+
+        print("Crawling new chapters ...")
+        pending = list()
+        dirty = set()
+        for chapter in self.adapter.get_chapters():
+            previous = known.get(str(chapter.number))
+            if previous is not None:
+                if (previous.url, previous.title, previous.volume) == (str(chapter.url), str(chapter.title), str(chapter.volume)):
+                    continue
+                self.remove_chapter(previous)
+                dirty.add(previous.volume)
+            pending.append(chapter)
+
+        self.crawl_chapters(pending, args)
+        for chapter in pending:
+            dirty.add(chapter.volume)
+            self.descriptor.volumes[chapter.volume].chapters.sort(key=lambda x: float(x.number))
+
+        if len(dirty) > 0:
+            print("{} new or changed chapters, dirty volumes: {}".format(len(pending), str.join(', ', sorted(dirty))))
+        else:
+            print("No new chapters")
+
+        self.dirty_volumes = dirty
+        return dirty
+
+    def crawl(self, args, cache_name=None):
+        metadata = self.adapter.get_meta()
+
+        if cache_name is not None:
+            pass
+        elif args.out is None:
+            cache_name = self.descriptor_name(metadata.slug, args)
         else:
-            cache_name = "{}.xml".format(args.out)
+            cache_name = self.descriptor_name(args.out, args)
+
+        if getattr(args, 'incremental', False) and os.path.exists(cache_name):
+            self.descriptor = Descriptor.load(cache_name)
+            self.descriptor.metadata = metadata
+            self.crawl_incremental(args)
+        else:
+            self.descriptor = Descriptor()
+            self.descriptor.metadata = metadata
+
+            print("Crawling ...")
+            self.crawl_chapters(self.adapter.get_chapters(), args)
 
         self.descriptor.save(cache_name)
 
@@ -138,33 +456,109 @@ class ScraperEngine(object):
             self.dir = args.out
 
         if self.descriptor is None:
-            self.descriptor = Descriptor.load(args.descriptor)
+            self.descriptor = Descriptor.open(args.descriptor)
 
         print("Building ...")
-        sorted_volumes = sorted(self.descriptor.volumes.values(), key=lambda vol: vol.number)
+        numbers = sorted(self.descriptor.volumes.keys())
 
-        # filter volumes
+        # filter volumes before reading them
         if len(args.volumes) > 0:
             volumes = [int(v) for v in args.volumes]
             print("Filtering volumes {}".format(volumes))
-            sorted_volumes = filter(lambda vol: int(vol.number) in volumes, sorted_volumes)
+            numbers = [number for number in numbers if volume_matches(number, volumes)]
 
         if args.parallel is None:
-            for_each(sorted_volumes, self.build_volume)
-        else:
-            with Pool(processes=args.parallel) as pool:
-                pool.map(self.build_volume, sorted_volumes)
+            return [self.build_volume(self.descriptor.volumes[number]) for number in numbers]
+        return self.build_parallel(numbers, args.parallel)
 
     def run(self, args):
         if args.out is not None:
             self.dir = args.out
 
-        cache_name = os.path.join(self.dir, "{}.xml".format(self.adapter.slug))
+        cache_name = os.path.join(self.dir, self.descriptor_name(self.adapter.slug, args))
+        try:
+            os.makedirs(self.dir)
+        except FileExistsError:
+            pass
+
         if not args.rebuild and os.path.exists(cache_name):
             print("Loading from cache")
-            self.descriptor = Descriptor.load(cache_name)
+            self.descriptor = Descriptor.open(cache_name)
+            if getattr(args, 'incremental', False):
+                self.crawl_incremental(args)
+        elif getattr(args, 'pipeline', False):
+            return self.run_pipeline(args, cache_name)
         else:
-            self.crawl(args)
+            self.crawl(args, cache_name)
 
-        self.build(args)
+        results = self.build(args)
         self.descriptor.save(cache_name)
+        return results
+
+    def run_pipeline(self, args, cache_name):
+        """
+        Crawl and build at the same time: chapters go through the crawl
+        threads, then the image download threads, and each volume is handed
+        to a builder thread as soon as its last chapter is through. Each
+        stage only runs a bounded number of chapters ahead of the next one,
+        and a stage waits while the builders are busy.
+
+        :param cache_name: Descriptor file, saved at the end with what was crawled
+        :return: [result of `build_volume_file`] in volume order
+        """
+        metadata = self.adapter.get_meta()
+        self.descriptor = Descriptor()
+        self.descriptor.metadata = metadata
+
+        print("Crawling and building ...")
+        # volumes are crawled in the order they are built
+        chapters = sorted(self.adapter.get_chapters(), key=lambda x: (str(x.volume), float(x.number)))
+        remaining = dict()
+        for chapter in chapters:
+            remaining[str(chapter.volume)] = remaining.get(str(chapter.volume), 0) + 1
+
+        volumes = [int(v) for v in args.volumes]
+        if len(volumes) > 0:
+            print("Filtering volumes {}".format(volumes))
+
+        def wanted(number):
+            return len(volumes) == 0 or volume_matches(number, volumes)
+
+        def fetch(chapter):
+            if wanted(chapter.volume):
+                self.prefetch_chapter(chapter)
+            return chapter
+
+        crawl_parallel = getattr(args, 'crawl_parallel', None) or 1
+        host_limit = getattr(args, 'crawl_host_limit', None)
+        builders = args.parallel or 1
+
+        def crawl(chapter):
+            # the image downloads and builds running meanwhile are not capped
+            with scheduler.capped(host_limit):
+                return self.crawl_chapter(chapter)
+
+        crawled = ordered_map(crawl, chapters, crawl_parallel)
+        fetched = ordered_map(fetch, crawled, self.format.page_parallel or 1)
+
+        results = list()
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=builders) as executor:
+                for chapter in fetched:
+                    self.add_chapter(chapter)
+                    remaining[chapter.volume] -= 1
+                    if remaining[chapter.volume] > 0 or not wanted(chapter.volume):
+                        continue
+
+                    pending.append(executor.submit(self.build_volume, self.descriptor.volumes[chapter.volume]))
+                    # stop pulling chapters while the builders are behind
+                    while len(pending) > builders:
+                        results.append(pending.popleft().result())
+
+                while len(pending) > 0:
+                    results.append(pending.popleft().result())
+        finally:
+            # keep what was crawled, an incremental run picks up the rest
+            self.descriptor.save(cache_name)
+        return results
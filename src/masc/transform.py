@@ -0,0 +1,204 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from masc.cache import image_cache
+from masc.metrics import metrics
+from masc.util import fetch_cached, copy_cached, prefetch_cached
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+}
+
+# leading bytes of the image formats pages come in
+SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF8', '.gif'),
+)
+
+
+def image_extension(data):
+    """
+    Extension of the format of an encoded image, .jpg when it is not recognized
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    for signature, extension in SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return '.jpg'
+
+
+class Transform(object):
+    """
+    Changes applied to page images before they are written: downscale to
+    a maximum height, re-encode and drop metadata (EXIF, ICC profile)
+    """
+
+    def __init__(self, max_height=None, quality=None, format=None, strip=True):
+        """
+        :param max_height: Taller images are scaled down to this height
+        :param quality: Encoder quality (JPEG and WebP)
+        :param format: jpeg or webp (default: keep the source format)
+        :param strip: Drop the metadata of the images
+        """
+        if format is not None and format not in FORMATS:
+            raise ValueError("unknown image format {}".format(format))
+        self.max_height = max_height
+        self.quality = quality
+        self.format = format
+        self.strip = strip
+
+    def extension(self):
+        """
+        :return: extension of the output, None when the source format is kept
+        """
+        if self.format is None:
+            return None
+        return FORMATS[self.format][1]
+
+    def cache_key(self, digest):
+        """
+        Cache key of the result of this transform on the image `digest`
+        """
+        return "transform:{}:h={},q={},f={},s={}".format(digest, self.max_height, self.quality,
+                                                         self.format, int(self.strip))
+
+    def failure_key(self, digest):
+        """
+        Cache key marking that this transform can't be applied to the image `digest`
+        """
+        return self.cache_key(digest) + ":failed"
+
+    def apply(self, data):
+        """
+        Transform an encoded image
+
+        :param data: Image as bytes
+        :return: bytes
+        """
+        image = Image.open(io.BytesIO(data))
+        image_format = FORMATS[self.format][0] if self.format is not None else image.format
+
+        if self.max_height is not None and image.height > self.max_height:
+            width = max(1, round(image.width * self.max_height / image.height))
+            image = image.resize((width, self.max_height), Image.LANCZOS)
+
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        options = dict()
+        if self.quality is not None:
+            options['quality'] = self.quality
+        if not self.strip:
+            for key in ('exif', 'icc_profile'):
+                if key in image.info:
+                    options[key] = image.info[key]
+
+        out = io.BytesIO()
+        image.save(out, format=image_format, **options)
+        return out.getvalue()
+
+    def __repr__(self):
+        return "Transform(max_height={}, quality={}, format={}, strip={})".format(self.max_height, self.quality,
+                                                                                 self.format, self.strip)
+
+
+def apply_transform(transform, data):
+    """
+    :return: bytes, None if Pillow can't transform the image
+    """
+    try:
+        return transform.apply(data)
+    except (OSError, ValueError) as e:
+        print("Cannot transform image: {}".format(e))
+        return None
+
+
+_lock = threading.Lock()
+_executor = None
+
+
+def executor():
+    """
+    Process pool shared by the transforms of this process, None in build
+    workers which can't start processes of their own. It is created from
+    the page threads, its processes are spawned rather than forked from a
+    process whose locks other threads may hold.
+    """
+    global _executor
+    if multiprocessing.current_process().daemon:
+        return None
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def run(transform, data):
+    with metrics.timer('transform'):
+        return run_transform(transform, data)
+
+
+def run_transform(transform, data):
+    pool = executor()
+    if pool is None:
+        return apply_transform(transform, data)
+    return pool.submit(apply_transform, transform, data).result()
+
+
+def transform_cached(url, transform):
+    """
+    Transformed content of the image at `url`, the result is kept in the
+    image cache so that the same transform is not applied twice. Images
+    the transform fails on are kept as they are, and only the failure is
+    cached.
+
+    :param url: Image url
+    :param transform: Transform instance
+    :return: (bytes, transformed), transformed is False for an untransformed image
+    """
+    digest = image_cache.digest(url)
+    if digest is None:
+        prefetch_cached(url)
+        digest = image_cache.digest(url)
+    if digest is None:
+        # evicted already
+        data = fetch_cached(url)
+        result = run(transform, data)
+        return (data, False) if result is None else (result, True)
+
+    out = io.BytesIO()
+    if copy_cached(transform.cache_key(digest), out):
+        metrics.count('transform.hit')
+        return out.getvalue(), True
+    if copy_cached(transform.failure_key(digest), None):
+        return fetch_cached(url), False
+
+    data = fetch_cached(url)
+    result = run(transform, data)
+    if result is None:
+        with image_cache.writer(transform.failure_key(digest)):
+            pass
+        return data, False
+
+    with image_cache.writer(transform.cache_key(digest)) as cache_file:
+        cache_file.write(result)
+    return result, True
+
+
+def transform_failed(url, transform):
+    """
+    Whether `transform` is known to fail on the image at `url`
+    """
+    digest = image_cache.digest(url)
+    return digest is not None and image_cache.lookup(transform.failure_key(digest)) is not None
@@ -1,17 +1,17 @@
+import io
 import os.path
-import requests
-import hashlib
-from bs4 import BeautifulSoup
+import shutil
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from masc.client import client, DEFAULT_HEADERS
+from masc.scheduler import scheduler, RETRY_ERRORS
+from masc.metrics import metrics
+from masc.cache import image_cache, page_cache
+from masc.extract import parse_html, charset
 
 
-DEFAULT_HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.111 Safari/537.36',
-    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-    'Accept-Encoding': 'gzip, deflate, sdch',
-    'Accept-Language': 'en-US,en;q=0.8,fr;q=0.6',
-    'Cache-Control': 'max-age=0',
-    'Connection': 'keep-alive'
-}
+CHUNK_SIZE = 64 * 1024
 
 
 class FetchError(Exception):
@@ -24,30 +24,170 @@ class FetchError(Exception):
 
 
 def fetch_cached(url):
-    cache = str.join(os.path.sep, ['cache'] + list(chunkify(hashlib.sha1(url.encode('utf-8')).hexdigest(), 8)))
-
-    if os.path.exists(cache):
-        return open(cache, mode='rb').read()
+    buffer = io.BytesIO()
+    stream_cached(url, buffer)
+    return buffer.getvalue()
+
+
+def stream_cached(url, out):
+    """
+    Copy the content of `url` into the file object `out` chunk by chunk.
+    On a cache miss the response body is written to the cache and to `out`
+    at the same time, so the content is never held in memory as a whole.
+    A download cut short is started over, only the bytes `out` has not
+    received yet are written to it.
+
+    :param url: URL to fetch
+    :param out: Writable binary file object (None to only fill the cache)
+    """
+    if copy_cached(url, out):
+        metrics.count('cache.hit')
+        return
+
+    with image_cache.lock(url):
+        # another worker may have downloaded it while we were waiting
+        if copy_cached(url, out):
+            metrics.count('cache.hit')
+            return
+
+        metrics.count('cache.miss')
+        # bytes of the body already copied to `out`, skipped when a download is retried
+        written = 0
+        attempt = 0
+        while True:
+            # failed requests are retried by the scheduler already, only the body is retried here
+            reading = False
+            try:
+                with metrics.timer('fetch'), scheduler.open(url, stream=True) as resp:
+                    reading = True
+                    if resp.status_code != 200:
+                        raise FetchError(resp.status_code, url)
+
+                    with image_cache.writer(url) as cache_file:
+                        offset = 0
+                        for chunk in resp.iter_content(CHUNK_SIZE):
+                            metrics.count('fetch.bytes', len(chunk))
+                            cache_file.write(chunk)
+                            if out is not None and offset + len(chunk) > written:
+                                out.write(chunk[max(written - offset, 0):])
+                                written = offset + len(chunk)
+                            offset += len(chunk)
+                return
+            except RETRY_ERRORS:
+                if not reading or attempt >= scheduler.retries:
+                    raise
+                # the host was paused when the body failed
+                scheduler.retry(0.0)
+                attempt += 1
+
+
+def copy_cached(url, out):
+    """
+    Copy the cached content of `url` into `out`
+
+    :return: False on a cache miss
+    """
+    path = image_cache.lookup(url)
+    if path is None:
+        return False
+    if out is None:
+        return True
+    try:
+        with open(path, mode='rb') as cache_file:
+            shutil.copyfileobj(cache_file, out, CHUNK_SIZE)
+        return True
+    except FileNotFoundError:
+        # evicted since the lookup
+        return False
+
+
+def head_cached(url, size):
+    """
+    First `size` bytes of the cached content of `url`
+
+    :return: bytes, None on a cache miss
+    """
+    path = image_cache.lookup(url)
+    if path is None:
+        return None
+    try:
+        with open(path, mode='rb') as cache_file:
+            return cache_file.read(size)
+    except FileNotFoundError:
+        # evicted since the lookup
+        return None
+
+
+def prefetch_cached(url):
+    """
+    Download `url` into the cache without returning its content
+    """
+    stream_cached(url, None)
+
+
+def fetch_html(url, cached=None):
+    """
+    Fetch a page and parse it with lxml
+
+    :param cached: Kind of page (meta, chapters or pages) to keep the page
+                   in the page cache with the TTL of its kind, None to
+                   always fetch it
+    :return: lxml.html.HtmlElement
+    """
+    if cached is not None and page_cache.enabled:
+        return fetch_html_cached(url, cached)
+
+    with metrics.timer('fetch.html'):
+        resp = scheduler.get(url)
+    if resp.status_code != 200:
+        raise FetchError(resp.status_code, url)
+
+    # hand the raw bytes to lxml instead of decoding them in python first
+    with metrics.timer('parse'):
+        return parse_html(resp.content, charset(resp.headers.get('Content-Type')))
+
+
+# parsed cached pages, by url, for pages used again by the same process
+TREES_SIZE = 16
+_trees = OrderedDict()
+_trees_lock = threading.Lock()
+
+
+def fetch_html_cached(url, kind):
+    """
+    Parsed page from the page cache, revalidated with the site once its
+    TTL is over. The tree of a page that didn't change is reused.
+    """
+    entry = page_cache.lookup(url)
+    if entry is not None and page_cache.is_fresh(entry, kind):
+        metrics.count('html.hit')
     else:
-        resp = requests.get(url, headers=DEFAULT_HEADERS)
-        if resp.status_code != 200:
+        headers = page_cache.validators(entry) if entry is not None else {}
+        with metrics.timer('fetch.html'):
+            resp = scheduler.get(url, headers=headers)
+        if resp.status_code == 304 and entry is not None:
+            metrics.count('html.not_modified')
+            page_cache.touch(url, resp)
+        elif resp.status_code == 200:
+            metrics.count('html.miss')
+            digest = page_cache.store(url, resp)
+            entry = {'digest': digest, 'body': resp.content, 'content_type': resp.headers.get('Content-Type')}
+        else:
             raise FetchError(resp.status_code, url)
 
-        os.makedirs(os.path.dirname(cache))
-        open(cache, mode='wb+').write(resp.content)
-        return resp.content
-
+    with _trees_lock:
+        memo = _trees.get(url)
+        if memo is not None and memo[0] == entry['digest']:
+            _trees.move_to_end(url)
+            return memo[1]
 
-def fetch_html(url, cached=False):
-    if cached:
-        resp = str(fetch_cached(url))
-    else:
-        resp = requests.get(url, headers=DEFAULT_HEADERS)
-        if resp.status_code != 200:
-            raise FetchError(resp.status_code, url)
-
-        resp = resp.text
-    return BeautifulSoup(resp, "lxml")
+    with metrics.timer('parse'):
+        tree = parse_html(entry['body'], charset(entry['content_type']))
+    with _trees_lock:
+        _trees[url] = (entry['digest'], tree)
+        while len(_trees) > TREES_SIZE:
+            _trees.popitem(last=False)
+    return tree
 
 
 def for_each(iterator, func):
@@ -55,6 +195,34 @@ def for_each(iterator, func):
         func(item)
 
 
+def ordered_map(func, items, parallel=None, window=None):
+    """
+    Apply `func` to `items` on a bounded thread pool and yield the results
+    in input order. At most `window` items are in flight at once.
+    Runs inline when `parallel` is None.
+    """
+    if parallel is None:
+        for item in items:
+            yield func(item)
+        return
+
+    if window is None:
+        window = parallel * 2
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def chunkify(seq, len):
     """A generator to divide a sequence into chunks of n units."""
     while seq: